@@ -6,7 +6,9 @@ import sys
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'resources', 'lib'))
 
 import lostfilm.routes
+from lostfilm.common import preconnect
 from support.common import run_plugin
 
 if __name__ == '__main__':
+    preconnect()
     run_plugin()
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark for xbmcswift2.storage.Storage.
+
+Measures open/load, get, set, commit and purge in cached and uncached modes
+for tables of different sizes, with values similar in size and structure to
+pickled Series, NewEpisodes and HideMeProxyList objects.
+
+Usage (from the addon root):
+
+    python benchmarks/storage_benchmark.py [--sizes 10,1000,20000]
+                                           [--payloads series,new_episodes,proxy_list]
+                                           [--modes cached,uncached] [--repeat 3]
+                                           [--max-mb 128] [--seed 0]
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import datetime
+import tempfile
+import timeit
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'resources', 'lib'))
+
+import logging
+logging.disable(logging.CRITICAL)
+
+from xbmcswift2.storage import Storage, encode
+
+timer = timeit.default_timer
+
+
+Series = namedtuple('Series', ['id', 'title', 'original_title', 'image', 'icon', 'poster', 'country', 'year',
+                               'genres', 'about', 'actors', 'producers', 'writers', 'plot', 'seasons_count',
+                               'episodes_count'])
+
+Episode = namedtuple('Episode', ['series_id', 'series_title', 'season_number', 'episode_number', 'episode_title',
+                                 'original_title', 'release_date', 'icon', 'poster', 'image'])
+
+
+class Media(object):
+    def __init__(self, folder, title, url, time_added=None, **payload):
+        self.folder = folder
+        self.title = title
+        self.url = url
+        self.time_added = time_added
+        self.payload = payload
+
+
+class Proxy(object):
+    def __init__(self, ip, port, country=None, protocols=None, ping=0, anonymity=None):
+        self.ip = ip
+        self.port = port
+        self.country = country
+        self.protocols = protocols or []
+        self.ping = ping
+        self.anonymity = anonymity
+
+
+class ProxyStats(object):
+    def __init__(self, successes, failures, latency, last_used):
+        self.successes = successes
+        self.failures = failures
+        self.consecutive_failures = 0
+        self.latency = latency
+        self.last_used = last_used
+        self.last_success = last_used
+        self.backoff_until = None
+
+
+class ProxyList(object):
+    def __init__(self, proxies):
+        self.sort_by = 'ping'
+        self.reverse = False
+        self.last_good_proxy = proxies[0]
+        self._proxy_counters = {'http': 3}
+        self._proxies = {'http': proxies}
+        self._stats = dict(("%s:%s" % (p.ip, p.port), ProxyStats(3, 1, 1.2, time.time())) for p in proxies[:50])
+        self.types = ['http']
+        self.countries = None
+        self.except_countries = ['RU']
+        self.anonymity = [1, 2, 3]
+        self.maxtime = None
+        self.ports = None
+
+
+WORDS = u"сериал сезон серия актер режиссер сюжет герой город история жизнь семья друзья время " \
+        u"series season episode drama comedy story life family friends time world".split()
+
+
+def text(rnd, words):
+    return u" ".join(rnd.choice(WORDS) for _ in xrange(words))
+
+
+def make_series(rnd, i):
+    return Series(i, text(rnd, 3), text(rnd, 3), u"http://www.lostfilm.tv/Static/posters/poster_%d.jpg" % i,
+                  u"http://www.lostfilm.tv/Static/icons/cat_%d.jpg" % i,
+                  u"http://i551.photobucket.com/albums/ii448/suslikcorp/lostfilm/posters/s%d-s01-lostfilm.jpg" % i,
+                  u"США", u"2015", [text(rnd, 1) for _ in xrange(3)], text(rnd, 60),
+                  [(text(rnd, 2), text(rnd, 2)) for _ in xrange(12)], [text(rnd, 2) for _ in xrange(3)],
+                  [text(rnd, 2) for _ in xrange(3)], text(rnd, 80), 5, 60)
+
+
+def make_episode(rnd, series_id, season, episode):
+    return Episode(series_id, text(rnd, 3), season, "%02d" % episode, text(rnd, 4), text(rnd, 4),
+                   datetime.date(2015, 1, 1) + datetime.timedelta(days=episode),
+                   u"http://www.lostfilm.tv/Static/icons/cat_%d.jpg" % series_id,
+                   u"http://i551.photobucket.com/albums/ii448/suslikcorp/lostfilm/posters/s-s%02d-lostfilm.jpg" % season,
+                   u"http://www.lostfilm.tv/Static/posters/poster_%d.jpg" % series_id)
+
+
+def make_new_episodes(rnd, i, count=30):
+    result = set()
+    for n in xrange(count):
+        e = make_episode(rnd, i, 1 + n / 10, 1 + n % 10)
+        result.add(Media(e.series_title, e.episode_title, u"plugin://plugin.video.lostfilm.tv/play_episode/%d/%d/%s"
+                         % (e.series_id, e.season_number, e.episode_number), e.release_date,
+                         season_number=e.season_number, episode_number=[int(e.episode_number)], episode=e))
+    return result
+
+
+def make_proxy_list(rnd, i, count=300):
+    proxies = [Proxy("%d.%d.%d.%d" % (rnd.randint(1, 254), rnd.randint(0, 254), rnd.randint(0, 254), i % 254),
+                     rnd.choice([80, 3128, 8080, 8000]), rnd.choice(["US", "DE", "FR", "UA"]), ['http'],
+                     rnd.randint(100, 5000), rnd.randint(1, 3)) for _ in xrange(count)]
+    return ProxyList(proxies)
+
+
+PAYLOADS = {
+    'series': make_series,
+    'new_episodes': make_new_episodes,
+    'proxy_list': make_proxy_list,
+}
+
+
+def open_storage(filename, cached):
+    # the same parameters as XBMCMixin.get_storage() uses
+    return Storage(filename, tablename='bench', ttl=7 * 24 * 60 * 60, autocommit=True, cached=cached,
+                   autopurge=True, autorecover=True)
+
+
+def measure(func, repeat):
+    best = None
+    for _ in xrange(repeat):
+        start = timer()
+        func()
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def populate(filename, values):
+    s = open_storage(filename, cached=False)
+    s.clear()
+    s.update(values)
+    s.close()
+
+
+def bench(directory, payload, size, cached, values, repeat, seed):
+    filename = os.path.join(directory, "%s_%d_%s.db" % (payload, size, "cached" if cached else "uncached"))
+    populate(filename, values)
+    keys = values.keys()
+    rnd = random.Random(seed)
+    ops = min(size, 1000)
+    results = {}
+
+    def open_close():
+        s = open_storage(filename, cached)
+        len(s) if cached else s.get(keys[0])
+        s.close()
+
+    results['open+close'] = measure(open_close, repeat)
+
+    s = open_storage(filename, cached)
+    len(s)
+    read_keys = [rnd.choice(keys) for _ in xrange(ops)]
+
+    def get():
+        for k in read_keys:
+            s[k]
+
+    results['get'] = ops / max(measure(get, repeat), 1e-9)
+
+    write_keys = [rnd.choice(keys) for _ in xrange(ops)]
+    fresh = [PAYLOADS[payload](rnd, k) for k in write_keys[:50]]
+
+    def set_():
+        for n, k in enumerate(write_keys):
+            s[k] = fresh[n % len(fresh)]
+
+    results['set'] = ops / max(measure(set_, repeat), 1e-9)
+
+    def commit():
+        for n, k in enumerate(write_keys[:10]):
+            s[k] = PAYLOADS[payload](rnd, k)
+        s.commit()
+
+    results['commit'] = measure(commit, repeat)
+    s.close()
+
+    def purge():
+        # expire every second row
+        s = open_storage(filename, False)
+        s._execute('UPDATE bench SET expire=DATETIME("NOW", "-1 SECONDS") WHERE ROWID % 2 = 0')
+        start = timer()
+        s.cached = cached
+        s.purge()
+        elapsed = timer() - start
+        s.close()
+        populate(filename, values)
+        return elapsed
+
+    results['purge'] = min(purge() for _ in xrange(repeat))
+    results['file size'] = os.path.getsize(filename)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="xbmcswift2 Storage benchmark")
+    parser.add_argument('--sizes', default="10,1000,20000")
+    parser.add_argument('--payloads', default=",".join(sorted(PAYLOADS)))
+    parser.add_argument('--modes', default="cached,uncached")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--max-mb', type=int, default=128,
+                        help="skip combinations whose data set is larger than this")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='storage_bench')
+    header = "%-13s %6s %-9s %10s %12s %12s %11s %10s %10s %10s" % \
+             ("payload", "keys", "mode", "value, B", "get, op/s", "set, op/s", "open+close", "commit", "purge",
+              "file size")
+    print header
+    print "-" * len(header)
+    try:
+        for payload in args.payloads.split(","):
+            for size in [int(s) for s in args.sizes.split(",")]:
+                rnd = random.Random(args.seed)
+                sample_size = len(encode(PAYLOADS[payload](rnd, 0)))
+                if sample_size * size > args.max_mb * 1024 * 1024:
+                    print "%-13s %6d %-9s %10d  skipped (data set exceeds %d MB)" % \
+                          (payload, size, "-", sample_size, args.max_mb)
+                    continue
+                values = dict((i, PAYLOADS[payload](rnd, i)) for i in xrange(size))
+                for mode in args.modes.split(","):
+                    r = bench(directory, payload, size, mode == 'cached', values, args.repeat, args.seed)
+                    print "%-13s %6d %-9s %10d %12.0f %12.0f %9.1fms %8.1fms %8.1fms %8.0fkB" % \
+                          (payload, size, mode, sample_size, r['get'], r['set'], r['open+close'] * 1000,
+                           r['commit'] * 1000, r['purge'] * 1000, r['file size'] / 1024.0)
+    finally:
+        shutil.rmtree(directory, True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,29 @@
 # -*- coding: utf-8 -*-
+import os
+import time
 from contextlib import closing
+from collections import OrderedDict
+from xml.sax.saxutils import escape, quoteattr
 from support import services, library
 
 import support.titleformat as tf
 from xbmcswift2 import xbmcgui, actions, xbmc, abort_requested
-from lostfilm.scraper import Episode, Series, Quality, LostFilmScraper
+from lostfilm.scraper import Episode, Series, Quality, LostFilmScraper, BlockedContent
 from support.torrent import TorrentFile
 from support.common import lang, date_to_str, singleton, save_files, purge_temp_dir, LocalizedError, \
-    batch, toggle_watched_menu
+    batch, toggle_watched_menu, notify, keep_stored
 from support.plugin import plugin
+from util.encoding import clean_filename
 
 
 BATCH_EPISODES_COUNT = 5
 BATCH_SERIES_COUNT = 20
 LIBRARY_ITEM_COLOR = "FFFFFB8B"
 NEW_LIBRARY_ITEM_COLOR = "lime"
+LIBRARY_VERIFY_INTERVAL = 7 * 24 * 60 * 60
+# if more folders are changed, the whole library is scanned
+MAX_SCANNED_FOLDERS = 20
+NFO_HEADER = '<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>'
 
 
 def info_menu(obj):
@@ -28,7 +37,7 @@ def go_to_series_menu(s):
 
 def download_menu(e):
     from xbmcswift2 import actions
-    if plugin.get_setting('torrent-client', int):
+    if plugin.cached_setting('torrent-client', int):
         return [(lang(40308), actions.background(plugin.url_for('download', series=e.series_id,
                                                                 season=e.season_number,
                                                                 episode=e.episode_number)))]
@@ -44,8 +53,7 @@ def library_menu(s):
     """
     :type s: Series
     """
-    items = library_items()
-    if s.id in items:
+    if s.id in library_items():
         return [(lang(40310), actions.background(plugin.url_for('remove_from_library', series_id=s.id)))]
     else:
         return [(lang(40309), actions.background(plugin.url_for('add_to_library', series_id=s.id)))]
@@ -55,7 +63,7 @@ def select_quality_menu(e):
     """
     :type e: Episode
     """
-    if plugin.get_setting('quality', int) > 0:
+    if plugin.cached_setting('quality', int) > 0:
         url = episode_url(e, True)
         if e.is_complete_season:
             return [(lang(40303), actions.update_view(url))]
@@ -104,7 +112,7 @@ def episode_label(e, same_series=False):
         label += tf.color(e.series_title, color) + " / " + e.episode_title
     else:
         label += tf.color(e.episode_title, color)
-    if e.original_title and plugin.get_setting('show-original-title', bool):
+    if e.original_title and plugin.cached_setting('show-original-title', bool):
         label += " / " + e.original_title
     return label
 
@@ -208,11 +216,11 @@ def series_label(s, highlight_library_items=True):
     else:
         color = 'white'
     label = tf.color(s.title, color)
-    if plugin.get_setting('show-original-title', bool):
+    if plugin.cached_setting('show-original-title', bool):
         label += " / " + s.original_title
-    new_episodes = library_new_episodes().get_by(series_id=s.id)
+    new_episodes = library_new_episodes().count_by(s.id)
     if new_episodes:
-        label += " (%s)" % tf.color(str(len(new_episodes)), NEW_LIBRARY_ITEM_COLOR)
+        label += " (%s)" % tf.color(str(new_episodes), NEW_LIBRARY_ITEM_COLOR)
     return label
 
 
@@ -266,8 +274,37 @@ def series_cache():
     return plugin.get_storage('series.db', 24 * 60 * 7, cached=False)
 
 
+# library items loaded in the current invocation
+_library_items = []
+
+
+def _forget_library_items():
+    del _library_items[:]
+
+
 def library_items():
-    return plugin.get_storage().setdefault('library_items', [])
+    """
+    IDs of the series added to the library. Loaded from the storage once per invocation, the returned
+    object is stored itself, so it should be changed only in place.
+
+    :rtype : LibraryItems
+    """
+    if not _library_items:
+        storage = plugin.get_storage()
+        items = storage.get('library_items')
+        if not isinstance(items, LibraryItems):
+            # plain list was stored before
+            items = storage['library_items'] = LibraryItems(items or [])
+        _library_items.append(items)
+        plugin.on_close(_forget_library_items)
+    return _library_items[0]
+
+
+def library_folders():
+    """
+    :return: Series ID -> name of the series folder in the library
+    """
+    return plugin.get_storage().setdefault('library_folders', {})
 
 
 def library_new_episodes():
@@ -280,14 +317,30 @@ def library_new_episodes():
 @singleton
 def get_scraper():
     from support.services import xrequests_session
-    anonymized_urls = plugin.get_storage().setdefault('anonymized_urls', [], ttl=24 * 60 * 7)
+    storage = plugin.get_storage()
+    # plain list of blocked URLs used before, replaced by learned patterns
+    storage.pop('anonymized_urls', None)
+    blocked_content = keep_stored('blocked_content', storage.setdefault('blocked_content', BlockedContent()))
+    blocked_content.purge()
+    stale_cache = plugin.get_storage('stale.db', 24 * 60 * 7)
+    # the scraper outlives the storage in the service, which closes storages on every iteration
+    plugin.on_close(stale_cache.sync)
     return LostFilmScraper(login=plugin.get_setting('login', unicode),
                            password=plugin.get_setting('password', unicode),
                            cookie_jar=plugin.addon_data_path('cookies'),
-                           xrequests_session=xrequests_session(),
+                           xrequests_session=xrequests_session(max_workers=BATCH_SERIES_COUNT),
                            max_workers=BATCH_SERIES_COUNT,
                            series_cache=series_cache(),
-                           anonymized_urls=anonymized_urls)
+                           blocked_content=blocked_content,
+                           stale_cache=stale_cache)
+
+
+def preconnect():
+    """
+    Connects to LostFilm hosts in background while the plugin is busy with routing and the rest
+    """
+    if plugin.get_setting('preconnect', bool):
+        get_scraper().preconnect()
 
 
 def play_torrent(torrent, file_id=None):
@@ -325,15 +378,155 @@ def check_first_start():
 
 
 def get_library():
+    import hashlib
+
     path = plugin.get_setting('library-path', unicode)
     path = xbmc.translatePath(path)
-    return library.Library(path)
+    # separate manifest for every library path, so changing the path doesn't confuse the sync
+    tablename = 'manifest_' + hashlib.md5(path.encode('utf-8') if isinstance(path, unicode) else path).hexdigest()
+    return library.Library(path, manifest=plugin.get_storage('library.db', tablename=tablename))
+
+
+def library_verification_needed():
+    """
+    Whether the library files should be checked against the manifest (from time to time, the files can be
+    changed by someone else)
+    """
+    storage = plugin.get_storage()
+    return time.time() - storage.get('library_verified_at', 0) >= LIBRARY_VERIFY_INTERVAL
 
 
 def is_authorized():
     return get_scraper().authorized()
 
 
+def nfo_tag(tag, value, **attrs):
+    if not value:
+        return ""
+    attrs = "".join(' %s=%s' % (k, quoteattr(v)) for k, v in attrs.iteritems())
+    return "<%s%s>%s</%s>" % (tag, attrs, escape(unicode(value)), tag)
+
+
+def tvshow_nfo(s):
+    """
+    :type s: Series
+    :rtype : unicode
+    """
+    lines = [NFO_HEADER, "<tvshow>",
+             nfo_tag('title', s.title),
+             nfo_tag('originaltitle', s.original_title),
+             nfo_tag('plot', s.plot or s.about),
+             nfo_tag('year', s.year),
+             nfo_tag('country', s.country)]
+    lines.extend(nfo_tag('genre', g) for g in s.genres or [])
+    lines.extend(nfo_tag('credits', w) for w in s.writers or [])
+    lines.extend(nfo_tag('director', p) for p in s.producers or [])
+    lines.extend("<actor>%s%s</actor>" % (nfo_tag('name', name), nfo_tag('role', role)) for name, role in s.actors or [])
+    lines.extend([nfo_tag('thumb', s.poster, aspect='poster'),
+                  nfo_tag('thumb', s.image),
+                  "<fanart>%s</fanart>" % nfo_tag('thumb', s.image) if s.image else "",
+                  "</tvshow>"])
+    return "\n".join(l for l in lines if l)
+
+
+def episode_nfo(media):
+    """
+    :type media: library.Episode
+    :rtype : unicode
+    """
+    e = media.payload['episode']
+    aired = date_to_str(e.release_date, '%Y-%m-%d') if e.release_date else None
+    lines = [NFO_HEADER]
+    for n in e.episode_numbers:
+        lines.extend(["<episodedetails>",
+                      nfo_tag('title', e.episode_title),
+                      nfo_tag('originaltitle', e.original_title),
+                      nfo_tag('showtitle', e.series_title),
+                      nfo_tag('season', e.season_number),
+                      nfo_tag('episode', n),
+                      nfo_tag('aired', aired),
+                      "</episodedetails>"])
+    return "\n".join(l for l in lines if l)
+
+
+def library_episodes(episodes):
+    """
+    :type episodes: list[Episode]
+    :rtype : list[library.Episode]
+    """
+    return [library.Episode(folder=e.series_title, title=e.episode_title, season_number=e.season_number,
+                            episode_number=e.episode_numbers, url=episode_url(e), time_added=e.release_date, episode=e)
+            for e in episodes if not e.is_complete_season]
+
+
+def scan_library(lib):
+    """
+    Lets XBMC know about changes of the library, only changed folders are scanned and cleaned
+
+    :type lib: library.Library
+    """
+    if not plugin.get_setting('update-xbmc-library', bool):
+        return
+    updated = lib.updated_folders
+    if updated:
+        plugin.wait_library_scan()
+        if len(updated) > MAX_SCANNED_FOLDERS:
+            plugin.log.info("Starting XBMC library update...")
+            plugin.update_library('video', plugin.get_setting('library-path', unicode))
+        else:
+            plugin.log.info("Starting XBMC library update of %d folder(s)..." % len(updated))
+            plugin.update_library_paths('video', [folder_path(f) for f in sorted(updated)])
+    cleaned = lib.cleaned_folders
+    if cleaned:
+        plugin.wait_library_scan()
+        plugin.log.info("Starting XBMC library clean of %d folder(s)..." % len(cleaned))
+        plugin.clean_library_paths('video', [folder_path(f) for f in sorted(cleaned)])
+
+
+def folder_path(folder):
+    """
+    :return: XBMC path of the library folder
+    """
+    return os.path.join(plugin.get_setting('library-path', unicode), clean_filename(folder), '')
+
+
+def add_series_to_library(series_id):
+    """
+    Creates files of the series without updating the whole library
+    """
+    scraper = get_scraper()
+    episodes = scraper.get_series_episodes(series_id)
+    if not episodes:
+        return
+    nfo = plugin.get_setting('library-nfo', bool)
+    lib = get_library()
+    folder = episodes[0].series_title
+    lib.sync_folder(folder, library_episodes(episodes),
+                    nfo=tvshow_nfo(scraper.get_series_cached(series_id)) if nfo else None,
+                    media_nfo=episode_nfo if nfo else None)
+    library_folders()[series_id] = folder
+    library_new_episodes().update(NewEpisodes(lib.added_medias))
+    lib.log_summary()
+    scan_library(lib)
+
+
+def remove_series_from_library(series_id):
+    """
+    Removes folder of the series without updating the whole library
+
+    :return: False if the folder of the series is unknown
+    """
+    folder = library_folders().pop(series_id, None)
+    if folder is None:
+        return False
+    lib = get_library()
+    # files are checked on the file system, the manifest might be not populated yet
+    lib.sync_folder(folder, [], verify=True)
+    lib.log_summary()
+    scan_library(lib)
+    return True
+
+
 def update_library():
     plugin.log.info("Starting LostFilm.TV library update...")
     progress = xbmcgui.DialogProgressBG()
@@ -341,39 +534,57 @@ def update_library():
     series_ids = library_items()
     total = len(series_ids)
     lib = get_library()
-    processed = 0
+    verify = library_verification_needed() or not lib.manifest
+    nfo = plugin.get_setting('library-nfo', bool)
+    new_episodes = library_new_episodes()
+    series_folders = library_folders()
+    folders = []
+    loaded = processed = 0
     with closing(progress):
         progress.create(lang(30000), lang(40409))
-        series_episodes = {}
+        # every batch is synced as soon as it's fetched, so the memory doesn't grow with the library
+        # and the progress isn't lost on abort
         for ids in batch(series_ids, BATCH_SERIES_COUNT):
-            series_episodes.update(scraper.get_series_episodes_bulk(ids))
+            added = len(lib.added_medias)
+            series = scraper.get_series_bulk(ids) if nfo else {}
+            for series_id, episodes in scraper.get_series_episodes_bulk(ids).iteritems():
+                loaded += 1
+                if not episodes:
+                    continue
+                folder = episodes[0].series_title
+                lib.sync_folder(folder, library_episodes(episodes), verify,
+                                nfo=tvshow_nfo(series[series_id]) if series_id in series else None,
+                                media_nfo=episode_nfo if nfo else None)
+                folders.append(folder)
+                series_folders[series_id] = folder
+            new_episodes |= NewEpisodes(lib.added_medias[added:])
             processed += len(ids)
             progress.update(processed * 100 / total)
             if abort_requested():
-                return
-        medias = []
-        for series_id, episodes in series_episodes.iteritems():
-            medias.extend(library.Episode(folder=e.series_title, title=e.episode_title,
-                                          season_number=e.season_number, episode_number=e.episode_numbers,
-                                          url=episode_url(e), time_added=e.release_date,
-                                          episode=e)
-                          for e in episodes if not e.is_complete_season)
-        lib.sync(medias)
-        new_episodes = library_new_episodes()
-        new_episodes |= NewEpisodes(lib.added_medias)
-    if plugin.get_setting('update-xbmc-library', bool):
-        if lib.added_medias or lib.created_medias or lib.updated_medias:
-            plugin.wait_library_scan()
-            plugin.log.info("Starting XBMC library update...")
-            plugin.update_library('video', plugin.get_setting('library-path', unicode))
-        if lib.removed_files:
-            plugin.wait_library_scan()
-            plugin.log.info("Starting XBMC library clean...")
-            plugin.clean_library('video')
+                # folders synced so far are still scanned below, not left for the next update
+                plugin.log.info("LostFilm.TV library update aborted.")
+                break
+        # folders of series which failed to load are unknown, so they could be removed by mistake
+        if loaded == total:
+            lib.remove_other_folders(folders, verify)
+            for series_id in [i for i in series_folders if i not in series_ids]:
+                del series_folders[series_id]
+            if verify:
+                plugin.get_storage()['library_verified_at'] = time.time()
+        lib.log_summary()
+    scan_library(lib)
     plugin.log.info("LostFilm.TV library update finished.")
     return lib.added_medias or lib.created_medias or lib.updated_medias or lib.removed_files
 
 
+def notify_stale_results():
+    """
+    Tells the user that the listing was built from saved data
+    """
+    if get_scraper().stale:
+        notify(lang(40411))
+
+
 def check_last_episode(e):
     storage = plugin.get_storage()
     if 'last_episode' in storage and storage['last_episode'] != e:
@@ -382,18 +593,172 @@ def check_last_episode(e):
     storage['last_episode'] = e
 
 
+def _normalize(n):
+    return str(n).lstrip('0')
+
+
 class NewEpisodes(set):
-    def remove_by(self, series_id=None, season_number=None, episode_number=None):
-        for e in self.copy():
-            episode = e.payload['episode']
-            if episode.matches(series_id, season_number, episode_number):
-                self.remove(e)
+    """
+    Set of library medias of new episodes with indexes by episode and by series. Indexes aren't pickled,
+    they are built on demand.
+    """
+
+    def __reduce__(self):
+        return self.__class__, (list(self),)
+
+    @staticmethod
+    def _keys(media):
+        e = media.payload['episode']
+        series = _normalize(e.series_id)
+        return (series, _normalize(e.season_number), _normalize(e.episode_number)), series
+
+    def _indexes(self):
+        """
+        :return: episode key -> medias, series key -> medias
+        """
+        try:
+            return self._by_episode, self._by_series
+        except AttributeError:
+            self._by_episode, self._by_series = {}, {}
+            for media in set.__iter__(self):
+                self._index(media)
+            return self._by_episode, self._by_series
+
+    def _index(self, media):
+        by_episode, by_series = self._indexes()
+        episode_key, series_key = self._keys(media)
+        by_episode.setdefault(episode_key, set()).add(media)
+        by_series.setdefault(series_key, set()).add(media)
+
+    def _unindex(self, media):
+        for index, key in zip(self._indexes(), self._keys(media)):
+            medias = index.get(key)
+            if medias is not None:
+                medias.discard(media)
+                if not medias:
+                    del index[key]
+
+    def _reindex(self):
+        self.__dict__.pop('_by_episode', None)
+        self.__dict__.pop('_by_series', None)
+
+    def add(self, media):
+        super(NewEpisodes, self).add(media)
+        self._index(media)
+
+    def remove(self, media):
+        super(NewEpisodes, self).remove(media)
+        self._unindex(media)
+
+    def discard(self, media):
+        if super(NewEpisodes, self).__contains__(media):
+            self.remove(media)
+
+    def pop(self):
+        media = super(NewEpisodes, self).pop()
+        self._unindex(media)
+        return media
+
+    def clear(self):
+        super(NewEpisodes, self).clear()
+        self._reindex()
+
+    def update(self, *others):
+        for other in others:
+            for media in other:
+                self.add(media)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def difference_update(self, *others):
+        super(NewEpisodes, self).difference_update(*others)
+        self._reindex()
+
+    def intersection_update(self, *others):
+        super(NewEpisodes, self).intersection_update(*others)
+        self._reindex()
+
+    def symmetric_difference_update(self, other):
+        super(NewEpisodes, self).symmetric_difference_update(other)
+        self._reindex()
+
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+
+    def __iand__(self, other):
+        self.intersection_update(other)
+        return self
+
+    def __ixor__(self, other):
+        self.symmetric_difference_update(other)
+        return self
 
     def get_by(self, series_id=None, season_number=None, episode_number=None):
-        return [e for e in self if e.payload['episode'].matches(series_id, season_number, episode_number)]
+        by_episode, by_series = self._indexes()
+        if series_id is not None and season_number is not None and episode_number is not None:
+            key = (_normalize(series_id), _normalize(season_number), _normalize(episode_number))
+            return list(by_episode.get(key, []))
+        medias = by_series.get(_normalize(series_id), []) if series_id is not None else set.__iter__(self)
+        return [e for e in medias if e.payload['episode'].matches(series_id, season_number, episode_number)]
+
+    def remove_by(self, series_id=None, season_number=None, episode_number=None):
+        for e in self.get_by(series_id, season_number, episode_number):
+            self.remove(e)
+
+    def count_by(self, series_id):
+        return len(self._indexes()[1].get(_normalize(series_id), []))
 
     def __contains__(self, item):
         if isinstance(item, Episode):
-            return any(e.payload['episode'] == item for e in self)
+            key = (_normalize(item.series_id), _normalize(item.season_number), _normalize(item.episode_number))
+            return key in self._indexes()[0]
         else:
             return super(NewEpisodes, self).__contains__(item)
+
+
+class LibraryItems(object):
+    """
+    Ordered set of IDs of the series added to the library
+    """
+
+    def __init__(self, series_ids=()):
+        self._ids = OrderedDict((i, None) for i in series_ids)
+
+    def __reduce__(self):
+        return self.__class__, (list(self),)
+
+    def add(self, series_id):
+        """
+        :return: False if the series is already in the set
+        """
+        if series_id in self._ids:
+            return False
+        self._ids[series_id] = None
+        return True
+
+    def remove(self, series_id):
+        """
+        :return: False if the series isn't in the set
+        """
+        return self._ids.pop(series_id, False) is None
+
+    def __contains__(self, series_id):
+        return series_id in self._ids
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __eq__(self, other):
+        return isinstance(other, LibraryItems) and self._ids.keys() == other._ids.keys()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, list(self))
@@ -8,11 +8,12 @@ from xbmcswift2.common import abort_requested
 from support.plugin import plugin
 from lostfilm.common import select_torrent_link, get_scraper, itemify_episodes, itemify_file, play_torrent, \
     itemify_series, BATCH_SERIES_COUNT, BATCH_EPISODES_COUNT, library_items, update_library_menu, \
-    library_new_episodes, NEW_LIBRARY_ITEM_COLOR, check_last_episode, check_first_start
+    library_new_episodes, NEW_LIBRARY_ITEM_COLOR, check_last_episode, check_first_start, add_series_to_library, \
+    remove_series_from_library, notify_stale_results
 from support.torrent import Torrent
 
 
-@plugin.route('/browse_season/<series>/<season>')
+@plugin.route('/browse_season/<int:series>/<int:season>')
 def browse_season(series, season):
     plugin.set_content('episodes')
     select_quality = plugin.request.arg('select_quality')
@@ -25,13 +26,13 @@ def browse_season(series, season):
     return with_fanart(items)
 
 
-@plugin.route('/play_file/<path>/<file_id>')
+@plugin.route('/play_file/<str:path>/<int:file_id>')
 def play_file(path, file_id):
     torrent = Torrent(file_name=path)
     play_torrent(torrent, file_id)
 
 
-@plugin.route('/download/<series>/<season>/<episode>')
+@plugin.route('/download/<int:series>/<int:season>/<episode>')
 def download(series, season, episode):
     link = select_torrent_link(series, season, episode, force=True)
     if not link:
@@ -40,7 +41,7 @@ def download(series, season, episode):
     download_torrent(torrent)
 
 
-@plugin.route('/play_episode/<series>/<season>/<episode>')
+@plugin.route('/play_episode/<int:series>/<int:season>/<episode>')
 def play_episode(series, season, episode):
     select_quality = plugin.request.arg('select_quality')
     link = select_torrent_link(series, season, episode, select_quality)
@@ -51,7 +52,7 @@ def play_episode(series, season, episode):
     play_torrent(torrent)
 
 
-@plugin.route('/browse_series/<series_id>')
+@plugin.route('/browse_series/<int:series_id>')
 def browse_series(series_id):
     plugin.set_content('episodes')
     scraper = get_scraper()
@@ -65,6 +66,7 @@ def browse_all_series():
     plugin.set_content('tvshows')
     scraper = get_scraper()
     all_series_ids = scraper.get_all_series_ids()
+    notify_stale_results()
     total = len(all_series_ids)
     for batch_ids in batch(all_series_ids, BATCH_SERIES_COUNT):
         if abort_requested():
@@ -90,21 +92,23 @@ def browse_library():
     plugin.finish(sort_methods=['unsorted', 'label'])
 
 
-@plugin.route('/add_to_library/<series_id>')
+@plugin.route('/add_to_library/<int:series_id>')
 def add_to_library(series_id):
-    items = library_items()
-    if series_id not in items:
-        items.append(series_id)
-    plugin.set_setting('update-library', True)
+    library_items().add(series_id)
+    try:
+        add_series_to_library(series_id)
+    except Exception:
+        # let the service do the full update
+        plugin.set_setting('update-library', True)
+        raise
 
 
-@plugin.route('/remove_from_library/<series_id>')
+@plugin.route('/remove_from_library/<int:series_id>')
 def remove_from_library(series_id):
-    items = library_items()
-    if series_id in items:
-        items.remove(series_id)
+    library_items().remove(series_id)
     library_new_episodes().remove_by(series_id=series_id)
-    plugin.set_setting('update-library', True)
+    if not remove_series_from_library(series_id):
+        plugin.set_setting('update-library', True)
 
 
 @plugin.route('/')
@@ -114,6 +118,7 @@ def index():
     per_page = plugin.get_setting('per-page', int)
     scraper = get_scraper()
     episodes = scraper.browse_episodes(skip)
+    notify_stale_results()
     if episodes and not skip:
         check_last_episode(episodes[0])
     check_first_start()
@@ -167,14 +172,14 @@ def update_library_on_demand():
     # update_library()
 
 
-@plugin.route('/toggle_episode_watched/<series_id>/<season>/<episode>')
+@plugin.route('/toggle_episode_watched/<int:series_id>/<int:season>/<episode>')
 def toggle_episode_watched(series_id, season, episode):
     xbmc.executebuiltin(actions.toggle_watched())
     if series_id in library_items():
         library_new_episodes().remove_by(series_id, season, episode)
 
 
-@plugin.route('/mark_series_watched/<series_id>')
+@plugin.route('/mark_series_watched/<int:series_id>')
 def mark_series_watched(series_id):
     xbmc.executebuiltin(actions.toggle_watched())
     if series_id in library_items():
@@ -3,14 +3,17 @@
 from __future__ import unicode_literals
 from collections import namedtuple
 import hashlib
+import time
 import re
+from urlparse import urlparse, parse_qs
 
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from support.common import str_to_date, Attribute
-from support.abstract.scraper import AbstractScraper, ScraperError, parse_size
+from support.abstract.scraper import AbstractScraper, ScraperError, parse_size, stale_fallback
 from util.encoding import ensure_str
 from util.htmldocument import HtmlDocument
 from util.timer import Timer
+from support.xrequests import ProxyProbe
 
 
 class Series(namedtuple('Series', ['id', 'title', 'original_title', 'image', 'icon', 'poster', 'country', 'year',
@@ -69,24 +72,87 @@ class Quality(Attribute):
 TorrentLink = namedtuple('TorrentLink', ['quality', 'url', 'size'])
 
 
+class BlockedContent(object):
+    """
+    Learned patterns of blocked URLs. Content is blocked per series, so URL is normalized to the series ID
+    (`cat` or `c` query parameter) if it has one, or to its path otherwise. Once a page is blocked, all pages
+    matching the same pattern are predicted to be blocked until the pattern expires.
+    """
+    SERIES_ID_PARAMS = ['cat', 'c']
+
+    def __init__(self, ttl=7 * 24 * 60 * 60):
+        self.ttl = ttl
+        # pattern -> expiration time
+        self._patterns = {}
+
+    def __eq__(self, other):
+        return isinstance(other, BlockedContent) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __len__(self):
+        return len(self._patterns)
+
+    def pattern(self, url):
+        parsed = urlparse(url)
+        params = parse_qs(parsed.query)
+        for name in self.SERIES_ID_PARAMS:
+            if params.get(name):
+                return 'series', params[name][0].lstrip('_')
+        return 'path', parsed.path
+
+    def add(self, url):
+        self._patterns[self.pattern(url)] = time.time() + self.ttl
+
+    def __contains__(self, url):
+        pattern = self.pattern(url)
+        expires = self._patterns.get(pattern)
+        if expires is None:
+            return False
+        if expires < time.time():
+            self._patterns.pop(pattern, None)
+            return False
+        return True
+
+    def purge(self):
+        now = time.time()
+        self._patterns = dict((k, v) for k, v in self._patterns.iteritems() if v >= now)
+
+
 class LostFilmScraper(AbstractScraper):
     BASE_URL = "http://www.lostfilm.tv"
     LOGIN_URL = "http://login1.bogi.ru/login.php"
     BLOCKED_MESSAGE = "Контент недоступен на территории Российской Федерации"
+    # telemetry endpoints
+    ENDPOINTS = [
+        ('browse', r'lostfilm\.tv/browse\.php'),
+        ('serials', r'lostfilm\.tv/serials\.php'),
+        ('nrdr', r'lostfilm\.tv/nrdr\.php'),
+        ('login', r'bogi\.ru/'),
+    ]
 
     def __init__(self, login, password, cookie_jar=None, xrequests_session=None, series_cache=None, max_workers=10,
-                 anonymized_urls=None):
-        super(LostFilmScraper, self).__init__(xrequests_session, cookie_jar)
+                 blocked_content=None, stale_cache=None):
+        super(LostFilmScraper, self).__init__(xrequests_session, cookie_jar, stale_cache)
         self.series_cache = series_cache if series_cache is not None else {}
         self.max_workers = max_workers
         self.response = None
         self.login = login
         self.password = password
         self.has_more = None
-        self.anonymized_urls = anonymized_urls if anonymized_urls is not None else []
+        self.blocked_content = blocked_content if blocked_content is not None else BlockedContent()
         self.session.headers['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/48.0.2564.116 Safari/537.36'
         self.session.add_proxy_need_check(self._check_content_is_blocked)
         self.session.add_proxy_validator(self._validate_proxy)
+        if not self.session.proxy_probe:
+            # MainDiv is at the top of the page, no need to download the rest of it through every candidate.
+            # Block page is checked by the validator on the real response.
+            self.session.proxy_probe = ProxyProbe(self.BASE_URL + '/browse.php', marker=b'id="MainDiv"',
+                                                  max_bytes=16 * 1024)
+        if self.session.telemetry:
+            for name, pattern in self.ENDPOINTS:
+                self.session.telemetry.add_endpoint(name, pattern)
 
     # noinspection PyUnusedLocal
     def _validate_proxy(self, proxy, request, response):
@@ -99,15 +165,18 @@ class LostFilmScraper(AbstractScraper):
                 return "Returned blocked content"
 
     def _check_content_is_blocked(self, request, response):
-        if request.url in self.anonymized_urls:
+        if request.url in self.blocked_content:
             return True
         elif response and self.BLOCKED_MESSAGE in response.text:
             self.log.info("Content of %s blocked, trying to use anonymous proxy..." % request.url)
-            self.anonymized_urls.append(request.url)
+            self.blocked_content.add(request.url)
             return True
         else:
             return False
 
+    def preconnect(self):
+        self.session.preconnect([self.BASE_URL, self.LOGIN_URL])
+
     def fetch(self, url, params=None, data=None, **request_params):
         self.response = super(LostFilmScraper, self).fetch(url, params, data, **request_params)
         encoding = self.response.encoding
@@ -175,6 +244,7 @@ class LostFilmScraper(AbstractScraper):
     def get_series_cached(self, series_id):
         return self.get_series_bulk([series_id])[series_id]
 
+    @stale_fallback
     def get_all_series_ids(self):
         doc = self.fetch(self.BASE_URL + "/serials.php")
         mid = doc.find('div', {'class': 'mid'})
@@ -268,6 +338,7 @@ class LostFilmScraper(AbstractScraper):
 
         return series
 
+    @stale_fallback(keep=['has_more'])
     def browse_episodes(self, skip=0):
         self.ensure_authorized()
         doc = self.fetch(self.BASE_URL + "/browse.php", {'o': skip})
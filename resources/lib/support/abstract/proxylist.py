@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
-from operator import attrgetter
+from operator import attrgetter, itemgetter
+import copy
 import threading
+import time
 from util import equal_dicts
 from util.causedexception import CausedException
 
@@ -41,10 +43,67 @@ class Proxy(object):
     def __ne__(self, other):
         return not self == other
 
+    def __hash__(self):
+        return hash((self.ip, self.port))
+
     def __repr__(self):
         return "<Proxy %s:%d>" % (self.ip, self.port)
 
 
+class ProxyStats(object):
+    """
+    Statistics of proxy usage: success/failure counts, EWMA of latency and exponential back-off after failures
+    """
+    LATENCY_ALPHA = 0.3
+    BACKOFF_BASE = 60
+    BACKOFF_MAX = 24 * 60 * 60
+
+    def __init__(self):
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency = None
+        self.last_used = None
+        self.last_success = None
+        self.backoff_until = None
+
+    def __eq__(self, other):
+        return other and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<ProxyStats +%d/-%d %s>" % (self.successes, self.failures,
+                                            "%.2fs" % self.latency if self.latency is not None else "n/a")
+
+    def success(self, latency):
+        now = time.time()
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.backoff_until = None
+        self.last_used = self.last_success = now
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = self.LATENCY_ALPHA * latency + (1 - self.LATENCY_ALPHA) * self.latency
+
+    def failure(self):
+        now = time.time()
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_used = now
+        backoff = min(self.BACKOFF_BASE * 2 ** (self.consecutive_failures - 1), self.BACKOFF_MAX)
+        self.backoff_until = now + backoff
+
+    @property
+    def success_rate(self):
+        return (self.successes + 1.0) / (self.successes + self.failures + 2.0)
+
+    def in_backoff(self, now=None):
+        return self.backoff_until is not None and self.backoff_until > (now or time.time())
+
+
 class ProxyListException(CausedException):
     pass
 
@@ -61,14 +120,18 @@ class NoProxiesAvailable(ProxyListException):
 
 class ProxyList(object):
     unpickable_properties = ['_lock']
+    # Proxies succeeded recently are preferred to those never tried
+    RECENT_SUCCESS_TIME = 3 * 24 * 60 * 60
 
     def __init__(self, sort_by=None, reverse=False):
         self.sort_by = sort_by
         self.reverse = reverse
         self.last_good_proxy = None
         self._lock = threading.RLock()
-        self._proxy_counters = {}
+        self._tried_proxies = {}
+        self._stats = {}
         self._proxies = None
+        self.loaded_at = None
 
     def __eq__(self, other):
         return equal_dicts(self.__dict__, other.__dict__, self.unpickable_properties)
@@ -83,9 +146,22 @@ class ProxyList(object):
         return result
 
     def __setstate__(self, _dict):
+        _dict.pop('_proxy_counters', None)
+        _dict.setdefault('_tried_proxies', {})
+        _dict.setdefault('_stats', {})
+        _dict.setdefault('loaded_at', None)
         self.__dict__ = _dict
         self._lock = threading.RLock()
 
+    def update(self, other):
+        """
+        Takes over the proxies and their statistics of the other list in place, so that sessions holding this list
+        see them (e.g. when the list was refreshed by another process)
+        """
+        state = copy.deepcopy(other.__getstate__())
+        with self._lock:
+            self.__dict__.update(state)
+
     def _sorted(self, proxies):
         sort_by = self.sort_by if isinstance(self.sort_by, list) else [self.sort_by]
         return sorted(proxies, key=attrgetter(*sort_by), reverse=self.reverse)
@@ -97,34 +173,106 @@ class ProxyList(object):
         with self._lock:
             if self._proxies is not None:
                 return
-            proxies = self._load_proxies()
+            self._set_proxies(self._load_proxies())
+
+    def _set_proxies(self, proxies):
+        with self._lock:
             if self.sort_by:
                 proxies = self._sorted(proxies)
             self._proxies = {}
             for proxy in proxies:
                 for proto in proxy.protocols:
                     self._proxies.setdefault(proto, []).append(proxy)
-            self._proxy_counters = {}
+            self._tried_proxies = {}
+            # forget proxies which are not in the list anymore
+            keys = set(self._key(p) for p in proxies)
+            self._stats = dict((k, v) for k, v in self._stats.iteritems() if k in keys)
+            if self.last_good_proxy and self._key(self.last_good_proxy) not in keys:
+                self.last_good_proxy = None
+            self.loaded_at = time.time()
+
+    @property
+    def age(self):
+        """
+        Seconds since the proxies were loaded, None if they weren't loaded yet
+        """
+        return time.time() - self.loaded_at if self.loaded_at is not None else None
 
     def reload(self):
         self._proxies = None
-        self._proxy_counters = {}
+        self._tried_proxies = {}
         self.last_good_proxy = None
 
+    def refresh(self):
+        """
+        Loads fresh proxies in place of the current ones. Unlike reload(), the current proxies and their
+        statistics are kept if the new list can't be obtained.
+
+        :raise ProxyListException: if loading failed
+        """
+        proxies = self._load_proxies()
+        if not proxies:
+            raise ProxiesListNotAvailable()
+        self._set_proxies(proxies)
+
     def proxies(self, proto=Proxy.HTTP):
         self._ensure_proxies_loaded()
         if proto not in self._proxies:
             raise NoProxiesAvailable(proto)
         return self._proxies[proto]
 
-    def _get_next_proxy(self, proto):
+    @staticmethod
+    def _key(proxy):
+        return "%s:%s" % (proxy.ip, proxy.port)
+
+    def stats(self, proxy):
+        """
+        :rtype : ProxyStats
+        """
         with self._lock:
-            counter = self._proxy_counters.setdefault(proto, 0)
-            if counter >= len(self.proxies(proto)):
-                self.reload()
-                return self._get_next_proxy(proto)
-            self._proxy_counters[proto] = counter + 1
-            return self._proxies[proto][counter]
-
-    def get_proxy(self, proto=Proxy.HTTP):
-        return self.last_good_proxy or self._get_next_proxy(proto)
+            return self._stats.setdefault(self._key(proxy), ProxyStats())
+
+    def report_success(self, proxy, latency):
+        with self._lock:
+            self.stats(proxy).success(latency)
+
+    def report_failure(self, proxy):
+        with self._lock:
+            self.stats(proxy).failure()
+
+    def _rank(self, proxy, index, now):
+        """
+        Sort key of the proxy: proxies which recently succeeded come first, ordered by latency weighted with
+        success rate, then untried proxies in the list order, then failed ones, and proxies in back-off at last.
+        """
+        stats = self._stats.get(self._key(proxy))
+        if not stats:
+            return 1, index
+        if stats.in_backoff(now):
+            return 3, stats.backoff_until
+        if stats.last_success and now - stats.last_success < self.RECENT_SUCCESS_TIME:
+            return 0, stats.latency / stats.success_rate
+        if not stats.failures:
+            return 1, index
+        return 2, index
+
+    def _get_next_proxy(self, proto, exclude=None):
+        with self._lock:
+            exclude = set(self._key(p) for p in exclude or [])
+            for _ in range(2):
+                tried = self._tried_proxies.setdefault(proto, set())
+                now = time.time()
+                candidates = [(self._rank(p, i, now), p) for i, p in enumerate(self.proxies(proto))
+                              if self._key(p) not in tried and self._key(p) not in exclude]
+                if candidates:
+                    _, proxy = min(candidates, key=itemgetter(0))
+                    tried.add(self._key(proxy))
+                    return proxy
+                # all proxies were tried, give them another round, the list itself is refreshed by the service
+                self._tried_proxies[proto] = set()
+            raise NoProxiesAvailable(proto)
+
+    def get_proxy(self, proto=Proxy.HTTP, exclude=None):
+        if self.last_good_proxy and self.last_good_proxy not in (exclude or []):
+            return self.last_good_proxy
+        return self._get_next_proxy(proto, exclude)
@@ -4,44 +4,128 @@ from __future__ import unicode_literals
 from support.abstract.proxylist import ProxyListException
 from support.common import LocalizedError, lowercase, lang
 from support.plugin import plugin
-from support.xrequests import NoValidProxiesFound, Session
+from support.xrequests import NoValidProxiesFound, CircuitOpen, Session, VersionedCookieJar
 from util.timer import Timer
 from requests import RequestException, Timeout
+from functools import wraps
 
 import os
+import time
 import pickle
 import logging
+import threading
+
+# seconds between saves of modified cookies, the rest is saved when the plugin closes
+COOKIES_SAVE_INTERVAL = 60
 
 
 class ScraperError(LocalizedError):
     pass
 
 
+# marks missing entries of the stale cache, stored results may be empty
+_missing = object()
+
+
+def stale_fallback(func=None, keep=()):
+    """
+    Remembers the last result of the scraper method and returns it while the host is unavailable (its circuit is
+    open), setting `stale` flag of the scraper until the end of the invocation. The results are kept in a cached
+    storage, which is loaded as a whole, so it's meant for small pages only.
+
+    :param keep: names of scraper attributes set by the method (e.g. `has_more`), they are remembered along with
+                 the result and restored when it's returned stale
+    """
+    if func is None:
+        return lambda f: stale_fallback(f, keep)
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        key = (func.__name__,) + args + tuple(sorted(kwargs.items()))
+        try:
+            result = func(self, *args, **kwargs)
+        except ScraperError as e:
+            stored = self.stale_cache.get(key, _missing) if self.stale_cache is not None else _missing
+            if stored is _missing or not any(isinstance(c, CircuitOpen) for c in e.cause):
+                raise
+            self.log.warn("%s, using stale result of %s%r" % (e.cause[0], func.__name__, key[1:]))
+            self.stale = True
+            result, state = stored
+            for name, value in state.iteritems():
+                setattr(self, name, value)
+            return result
+        if self.stale_cache is not None:
+            self.stale_cache[key] = (result, dict((name, getattr(self, name)) for name in keep))
+        return result
+
+    return wrapper
+
+
 class AbstractScraper(object):
-    def __init__(self, xrequests_session, cookie_jar=None):
+    def __init__(self, xrequests_session, cookie_jar=None, stale_cache=None):
         """
         :type cookie_jar: str
         :type xrequests_session: Session
+        :param stale_cache: dict-like storage of the last results of methods decorated with @stale_fallback
         """
         self.log = logging.getLogger(__name__)
         self.cookie_jar = cookie_jar
         self.session = xrequests_session
-        self.cookie_str = None
+        self.cookies_version = None
+        self.cookies_saved_at = time.time()
+        self._cookies_lock = threading.Lock()
+        self.stale_cache = stale_cache
+        # whether some of the results returned in this invocation were stale
+        self.stale = False
         self.load_cookies()
+        plugin.on_close(self.save_cookies)
+        plugin.on_close(self.reset_stale)
 
     def load_cookies(self):
+        jar = VersionedCookieJar()
         if self.cookie_jar and os.path.exists(self.cookie_jar):
-            with open(self.cookie_jar, 'rb') as f:
-                self.session.cookies = pickle.load(f)
-                self.cookie_str = str(self.session.cookies)
+            try:
+                with open(self.cookie_jar, 'rb') as f:
+                    jar.update(pickle.load(f))
+            except Exception as e:
+                self.log.warn("Can't load cookies from %s: %s" % (self.cookie_jar, e))
+        self.session.cookies = jar
+        self.cookies_version = jar.version
 
     def save_cookies(self):
-        if self.cookie_jar:
-            new_cookie_str = str(self.session.cookies)
-            if self.cookie_str != new_cookie_str:
-                with open(self.cookie_jar, 'wb') as f:
-                    pickle.dump(self.session.cookies, f)
-                self.cookie_str = new_cookie_str
+        """
+        Saves cookies if they were modified since the last save. The file is replaced atomically, so an interrupted
+        write doesn't corrupt it.
+        """
+        if not self.cookie_jar:
+            return
+        with self._cookies_lock:
+            jar = self.session.cookies
+            version = jar.version
+            if version == self.cookies_version:
+                return
+            tmp_path = self.cookie_jar + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(jar, f)
+            try:
+                os.rename(tmp_path, self.cookie_jar)
+            except OSError:
+                # Windows can't rename over an existing file
+                os.remove(self.cookie_jar)
+                os.rename(tmp_path, self.cookie_jar)
+            self.cookies_version = version
+            self.cookies_saved_at = time.time()
+
+    def reset_stale(self):
+        self.stale = False
+
+    def save_cookies_later(self):
+        """
+        Saves modified cookies at most once per COOKIES_SAVE_INTERVAL seconds
+        """
+        if self.session.cookies.version != self.cookies_version and \
+                time.time() - self.cookies_saved_at >= COOKIES_SAVE_INTERVAL:
+            self.save_cookies()
 
     def fetch(self, url, params=None, data=None, **request_params):
         try:
@@ -50,12 +134,14 @@ class AbstractScraper(object):
                                                 url, params=params, data=data,
                                                 **request_params)
                 response.raise_for_status()
-                self.save_cookies()
+                self.save_cookies_later()
                 return response
         except Timeout as e:
             raise ScraperError(32000, "Timeout while fetching URL: %s (%%s)" % url, lang(30000), cause=e)
         except NoValidProxiesFound as e:
             raise ScraperError(32005, "Can't find anonymous proxy", cause=e)
+        except CircuitOpen as e:
+            raise ScraperError(32019, "Host %s is unavailable (%%s)" % e.host, lang(30000), cause=e)
         except RequestException as e:
             raise ScraperError(32001, "Can't fetch URL: %s (%%s)" % url, lang(30000), cause=e)
         except ProxyListException as e:
@@ -209,6 +209,19 @@ def singleton(func):
     return singleton_wrapper
 
 
+def keep_stored(key, obj):
+    """
+    Puts the object back to the main storage at the end of every invocation. Needed for stored objects held by
+    singletons: the service reopens storages on every iteration, so changes of the object loaded by the first one
+    wouldn't be saved anymore.
+    """
+    def store():
+        plugin.get_storage()[key] = obj
+
+    plugin.on_close(store)
+    return obj
+
+
 def batch(iterable, size=None):
     from itertools import islice, chain
     size = size or plugin.get_setting('batch-results', int)
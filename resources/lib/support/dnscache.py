@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import time
+import socket
+import logging
+import threading
+
+# noinspection PyPep8Naming
+from socket import timeout as SocketTimeout
+from requests.packages.urllib3 import connectionpool, poolmanager
+from requests.packages.urllib3.connection import HTTPConnection, HTTPSConnection
+from requests.packages.urllib3.exceptions import ConnectTimeoutError
+from requests.packages.urllib3.util import connection
+
+
+class DnsCache(object):
+    """
+    Resolved host addresses with expiration time. Picklable, so it can be persisted between plugin invocations.
+    """
+    unpickable_properties = ['_lock', 'log']
+
+    def __init__(self, ttl=60 * 60):
+        self.ttl = ttl
+        # host -> (address, expiration time)
+        self._addresses = {}
+        self._lock = threading.RLock()
+        self.log = logging.getLogger(__name__)
+
+    def __getstate__(self):
+        result = self.__dict__.copy()
+        for p in self.unpickable_properties:
+            del result[p]
+        return result
+
+    def __setstate__(self, _dict):
+        self.__dict__ = _dict
+        self._lock = threading.RLock()
+        self.log = logging.getLogger(__name__)
+
+    def __eq__(self, other):
+        return isinstance(other, DnsCache) and self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def resolve(self, host, port):
+        """
+        :return: IP address of the host, cached one if it's not expired yet
+        """
+        now = time.time()
+        with self._lock:
+            address, expires = self._addresses.get(host, (None, 0))
+        if expires > now:
+            return address
+        info = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        address = info[0][4][0]
+        if address != host:
+            self.log.debug("Resolved %s to %s" % (host, address))
+            with self._lock:
+                self._addresses[host] = (address, now + self.ttl)
+        return address
+
+    def forget(self, host):
+        with self._lock:
+            self._addresses.pop(host, None)
+
+    def purge(self):
+        now = time.time()
+        with self._lock:
+            self._addresses = dict((k, v) for k, v in self._addresses.iteritems() if v[1] > now)
+
+
+class CachedDnsConnectionMixin(object):
+    def __init__(self, *args, **kwargs):
+        self.dns_cache = kwargs.pop('dns_cache', None)
+        super(CachedDnsConnectionMixin, self).__init__(*args, **kwargs)
+
+    def _new_conn(self):
+        if not self.dns_cache:
+            return super(CachedDnsConnectionMixin, self)._new_conn()
+
+        extra_kw = {}
+        if self.source_address:
+            extra_kw['source_address'] = self.source_address
+        if self.socket_options:
+            extra_kw['socket_options'] = self.socket_options
+
+        address = self.dns_cache.resolve(self.host, self.port)
+        try:
+            return connection.create_connection((address, self.port), self.timeout, **extra_kw)
+        except SocketTimeout:
+            self.dns_cache.forget(self.host)
+            raise ConnectTimeoutError(self, "Connection to %s timed out. (connect timeout=%s)" %
+                                      (self.host, self.timeout))
+        except socket.error:
+            # the address may be outdated
+            self.dns_cache.forget(self.host)
+            raise
+
+
+class CachedDnsHTTPConnection(CachedDnsConnectionMixin, HTTPConnection):
+    pass
+
+
+class CachedDnsHTTPSConnection(CachedDnsConnectionMixin, HTTPSConnection):
+    pass
+
+
+class CachedDnsHTTPConnectionPool(connectionpool.HTTPConnectionPool):
+    ConnectionCls = CachedDnsHTTPConnection
+
+
+class CachedDnsHTTPSConnectionPool(connectionpool.HTTPSConnectionPool):
+    ConnectionCls = CachedDnsHTTPSConnection
+
+
+class CachedDnsPoolManager(poolmanager.PoolManager):
+    """
+    Pool manager which resolves host names with the given DnsCache (`dns_cache` keyword argument)
+    """
+    pool_classes_by_scheme = {
+        'http': CachedDnsHTTPConnectionPool,
+        'https': CachedDnsHTTPSConnectionPool,
+    }
+
+    def _new_pool(self, scheme, host, port):
+        pool_cls = self.pool_classes_by_scheme[scheme]
+        kwargs = self.connection_pool_kw
+        if scheme == 'http':
+            kwargs = self.connection_pool_kw.copy()
+            for kw in poolmanager.SSL_KEYWORDS:
+                kwargs.pop(kw, None)
+        return pool_cls(host, port, **kwargs)
@@ -1,10 +1,11 @@
 # -*- coding: utf-8 -*-
 import logging
+import hashlib
 import requests
 from support.abstract.proxylist import *
 from concurrent.futures import ThreadPoolExecutor
 from util.htmldocument import HtmlDocument
-from util.pygif import GifDecoder
+from util.pygif import decode_image
 
 
 def split_by_n(line, n):
@@ -35,6 +36,11 @@ class HideMeProxyList(ProxyList):
                    250121207606193L,  # 9
                    281474976710655L,  # Space
                    ]
+    GLYPH_DIGITS = dict((glyph, digit) for digit, glyph in enumerate(PORT_GLYPHS))
+
+    # many proxies share the same port image, so recognized ports are cached by image content hash
+    _port_cache = {}
+    PORT_CACHE_SIZE = 10000
 
     unpickable_properties = ProxyList.unpickable_properties[:]
     unpickable_properties.extend(['log', 'requests_session'])
@@ -120,30 +126,38 @@ class HideMeProxyList(ProxyList):
         }
 
     def _recognize_port(self, filename, gif_content):
-        gif = GifDecoder(gif_content)
-        if gif.ls_width != 32 or gif.ls_height != 12:
+        key = hashlib.sha1(gif_content).digest()
+        port = self._port_cache.get(key)
+        if port is None:
+            port = self._decode_port(filename, gif_content)
+            if len(self._port_cache) >= self.PORT_CACHE_SIZE:
+                self._port_cache.clear()
+            self._port_cache[key] = port
+        return port
+
+    def _decode_port(self, filename, gif_content):
+        try:
+            width, height, pixels = decode_image(gif_content)
+        except ValueError as e:
+            self.log.warn("Can't decode port image %s: %s" % (filename, e))
+            return False
+        if width != 32 or height != 12 or len(pixels) < 32 * 12:
             self.log.warn('Proxy port image should be 32x12 size, skipping %s' % filename)
             return False
-        pixels = gif.images[0].pixels
         port = 0
         exp = 1
         for n in reversed(xrange(5)):
             glyph = 0L
-            glyph_str = ""
             i = 0
             for y in xrange(3, 11):
                 for x in xrange(n * 6, (n + 1) * 6):
-                    pixel = pixels[y * 32 + x]
-                    glyph_str += "X" if not pixel else " "
-                    glyph += (pixel << i)
+                    glyph += pixels[y * 32 + x] << i
                     i += 1
-                glyph_str += "\n"
-            try:
-                digit = self.PORT_GLYPHS.index(glyph)
-            except ValueError:
+            digit = self.GLYPH_DIGITS.get(glyph)
+            if digit is None:
                 self.log.warn('Glyph not recognized, skipping %s' % filename)
                 self.log.info('Hash: %ld' % glyph)
-                self.log.info('Figure:\n' + glyph_str)
+                self.log.info('Figure:\n' + self._glyph_figure(pixels, n))
                 return False
             if digit >= 10:
                 continue
@@ -151,6 +165,11 @@ class HideMeProxyList(ProxyList):
             exp *= 10
         return port
 
+    @staticmethod
+    def _glyph_figure(pixels, n):
+        return "".join("".join(" " if pixels[y * 32 + x] else "X" for x in xrange(n * 6, (n + 1) * 6)) + "\n"
+                       for y in xrange(3, 11))
+
     def _download_port_gif_and_recognize(self, url):
         try:
             res = self.requests_session.get(url)
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
+from collections import namedtuple, OrderedDict
 from contextlib import closing
 from util.encoding import clean_filename, encode_fs, decode_fs
 import time
+import hashlib
 import logging
 import os
 
@@ -25,7 +27,8 @@ class Media(object):
     def __hash__(self):
         d = self.__dict__.copy()
         del d['payload']
-        return hash(str(d))
+        # the order of dict items may differ after unpickling
+        return hash(str(sorted(d.items())))
 
     def __ne__(self, other):
         return not self == other
@@ -56,14 +59,26 @@ class Episode(Media):
         return "%d%s %s" % (self.season_number, episodes_str, super(Episode, self).filename)
 
 
+# url and modification time of created stream file
+ManifestEntry = namedtuple('ManifestEntry', ['url', 'mtime'])
+# fingerprint of created .nfo file content
+NfoEntry = namedtuple('NfoEntry', ['fingerprint'])
+
+TVSHOW_NFO = 'tvshow.nfo'
+
+
 class StreamFile(object):
     def __init__(self, media, base_path):
         self.base_path = base_path
         self.media = media
 
+    @property
+    def relative_path(self):
+        return self.media.path + '.strm'
+
     @property
     def path(self):
-        return os.path.join(self.base_path, self.media.path + '.strm')
+        return os.path.join(self.base_path, self.relative_path)
 
     @property
     def encoded_path(self):
@@ -87,15 +102,56 @@ class StreamFile(object):
         return self.timestamp and os.path.getmtime(self.encoded_path) != self.timestamp
 
 
+class NfoFile(object):
+    def __init__(self, relative_path, content, base_path):
+        """
+        :type content: unicode
+        """
+        self.relative_path = relative_path
+        self.content = content.encode('utf-8')
+        self.base_path = base_path
+
+    @property
+    def path(self):
+        return os.path.join(self.base_path, self.relative_path)
+
+    @property
+    def encoded_path(self):
+        return encode_fs(self.path, errors='ignore')
+
+    @property
+    def fingerprint(self):
+        return hashlib.md5(self.content).hexdigest()
+
+    def is_updated(self):
+        with closing(open(self.encoded_path, 'rb')) as fd:
+            return fd.read() != self.content
+
+    def create(self):
+        dirname = os.path.dirname(self.encoded_path)
+        if not os.path.exists(dirname):
+            os.mkdir(dirname)
+        with closing(open(self.encoded_path, 'wb')) as fd:
+            fd.write(self.content)
+
+
 class Library(object):
 
-    def __init__(self, path):
+    def __init__(self, path, manifest=None):
+        """
+        :param manifest: dict-like storage of created files (path relative to the library -> ManifestEntry),
+                         if given, sync() touches the file system only for changed files
+        """
         self.path = path
+        self.manifest = manifest
+        # folder -> paths of the manifest, built on demand
+        self._folders = None
         self.log = logging.getLogger(__name__)
         self.created_medias = []
         self.added_medias = []
         self.removed_files = []
         self.updated_medias = []
+        self.updated_nfo_files = []
 
         if not os.path.exists(self.encoded_path):
             os.mkdir(self.encoded_path)
@@ -129,43 +185,212 @@ class Library(object):
             self.log.info("'%s' has removed" % decode_fs(path))
             os.rmdir(path)
 
-    def sync(self, medias):
+    def _folder_index(self):
+        """
+        :return: Folder name -> set of manifest paths in the folder
+        """
+        if self._folders is None:
+            self._folders = {}
+            for relative_path in self.manifest.keys():
+                self._folders.setdefault(relative_path.split(os.sep, 1)[0], set()).add(relative_path)
+        return self._folders
+
+    def _set_entry(self, relative_path, entry):
+        self.manifest[relative_path] = entry
+        self._folder_index().setdefault(relative_path.split(os.sep, 1)[0], set()).add(relative_path)
+
+    def _del_entry(self, relative_path):
+        del self.manifest[relative_path]
+        folder = relative_path.split(os.sep, 1)[0]
+        paths = self._folder_index().get(folder)
+        if paths is not None:
+            paths.discard(relative_path)
+            if not paths:
+                del self._folders[folder]
+
+    def _remove_file(self, relative_path):
+        """
+        Removes the file of the manifest and its folder if it's left empty
+        """
+        path = os.path.join(self.path, relative_path)
+        encoded_path = encode_fs(path, errors='ignore')
+        try:
+            os.remove(encoded_path)
+        except OSError as e:
+            self.log.warn("Can't remove '%s': %s" % (path, e))
+        self.removed_files.append(path)
+        self._del_entry(relative_path)
+        self.log.info("'%s' has removed" % path)
+
+        dirname = os.path.dirname(encoded_path)
+        try:
+            if dirname != self.encoded_path and not os.listdir(dirname):
+                os.rmdir(dirname)
+                self.log.info("'%s' has removed" % decode_fs(dirname))
+        except OSError:
+            pass
+
+    def _sync_media(self, media, trusted, created_dirs):
+        f = StreamFile(media, self.path)
+        path = f.path
+        encoded_path = encode_fs(path, errors='ignore')
+        entry = self.manifest.get(f.relative_path) if self.manifest is not None else None
+        if trusted and entry is not None:
+            if entry.url != media.url:
+                self.log.info("'%s' has updated" % path)
+                self.updated_medias.append(media)
+                f.create()
+            elif f.timestamp and entry.mtime != f.timestamp:
+                self.log.info("'%s' has updated" % path)
+                self.updated_medias.append(media)
+                f.touch()
+        elif os.path.exists(encoded_path):
+            if f.is_updated():
+                self.log.info("'%s' has updated" % path)
+                self.updated_medias.append(media)
+                f.touch()
+        else:
+            dirname = os.path.dirname(encoded_path) + "/"
+            if dirname in created_dirs:
+                self.created_medias.append(media)
+                self.log.info("'%s' has created" % path)
+            elif not os.path.exists(dirname):
+                os.mkdir(dirname)
+                created_dirs.append(dirname)
+                self.created_medias.append(media)
+                self.log.info("'%s' has created" % path)
+            else:
+                self.added_medias.append(media)
+                self.log.info("'%s' has added" % path)
+            f.create()
+        if self.manifest is not None:
+            new_entry = ManifestEntry(media.url, f.timestamp)
+            if entry != new_entry:
+                self._set_entry(f.relative_path, new_entry)
+        return f
+
+    def _sync_nfo(self, relative_path, content, trusted):
+        """
+        Writes .nfo file if its content is changed
+        """
+        f = NfoFile(relative_path, content, self.path)
+        entry = self.manifest.get(relative_path) if self.manifest is not None else None
+        fingerprint = f.fingerprint
+        if trusted and entry is not None and entry.fingerprint == fingerprint:
+            return f
+        if not os.path.exists(f.encoded_path) or (entry.fingerprint != fingerprint if entry else f.is_updated()):
+            self.log.debug("'%s' has written" % f.path)
+            self.updated_nfo_files.append(relative_path)
+            f.create()
+        if self.manifest is not None and entry != NfoEntry(fingerprint):
+            self._set_entry(relative_path, NfoEntry(fingerprint))
+        return f
+
+    def sync_folder(self, folder, medias, verify=False, nfo=None, media_nfo=None):
+        """
+        Syncs files of one folder (e.g. of one series), other files of the folder are removed.
+        Results are added to created_medias, added_medias, updated_medias and removed_files.
+
+        :type medias: list[Media]
+        :param verify: Check all files of the folder on the file system instead of trusting the manifest,
+                       the manifest is repaired
+        :param nfo: Content of tvshow.nfo of the folder
+        :param media_nfo: Function returning content of .nfo file of the given media
+        """
+        folder = clean_filename(folder)
+        trusted = self.manifest is not None and not verify
+        created_dirs = []
+        all_files = []
+        wanted = set()
+        for media in medias:
+            f = self._sync_media(media, trusted, created_dirs)
+            all_files.append(f.path)
+            wanted.add(f.relative_path)
+            content = media_nfo(media) if media_nfo else None
+            if content:
+                f = self._sync_nfo(media.path + '.nfo', content, trusted)
+                all_files.append(f.path)
+                wanted.add(f.relative_path)
+        if nfo and medias:
+            f = self._sync_nfo(os.path.join(folder, TVSHOW_NFO), nfo, trusted)
+            all_files.append(f.path)
+            wanted.add(f.relative_path)
+
+        if not trusted:
+            encoded_path = encode_fs(os.path.join(self.path, folder), errors='ignore')
+            if os.path.isdir(encoded_path):
+                self._remove_unwanted_files(all_files, encoded_path)
+        if self.manifest is not None:
+            for relative_path in list(self._folder_index().get(folder, [])):
+                if relative_path in wanted:
+                    continue
+                if trusted:
+                    self._remove_file(relative_path)
+                else:
+                    self._del_entry(relative_path)
+
+    def remove_other_folders(self, folders, verify=False):
+        """
+        Removes all folders (and files at the top level) except the given ones
+
+        :param verify: Look for unwanted files on the file system instead of the manifest
+        """
+        keep = set(clean_filename(f) for f in folders)
+        if self.manifest is not None:
+            for folder in [f for f in self._folder_index() if f not in keep]:
+                for relative_path in list(self._folders[folder]):
+                    if verify:
+                        self._del_entry(relative_path)
+                    else:
+                        self._remove_file(relative_path)
+        if verify or self.manifest is None:
+            for name in os.listdir(self.encoded_path):
+                if decode_fs(name) in keep:
+                    continue
+                path = os.path.join(self.encoded_path, name)
+                if os.path.isdir(path):
+                    self._remove_unwanted_files([], path)
+                else:
+                    self.log.info("'%s' has removed" % decode_fs(path))
+                    self.removed_files.append(decode_fs(path))
+                    os.remove(path)
+
+    def sync(self, medias, verify=False):
         """
         :type medias: list[Media]
+        :param verify: Check all files on the file system instead of trusting the manifest, the manifest is repaired
         """
         self.created_medias = []
         self.added_medias = []
         self.updated_medias = []
+        self.updated_nfo_files = []
 
-        created_dirs = []
-        all_files = []
         self.log.info('Starting library sync...')
+        folders = OrderedDict()
         for media in medias:
-            f = StreamFile(media, self.path)
-            path = f.path
-            encoded_path = encode_fs(path, errors='ignore')
-            all_files.append(path)
-            if os.path.exists(encoded_path):
-                if f.is_updated():
-                    self.log.info("'%s' has updated" % path)
-                    self.updated_medias.append(media)
-                    f.touch()
-            else:
-                dirname = os.path.dirname(encoded_path) + "/"
-                if dirname in created_dirs:
-                    self.created_medias.append(f)
-                    self.log.info("'%s' has created" % path)
-                elif not os.path.exists(dirname):
-                    os.mkdir(dirname)
-                    created_dirs.append(dirname)
-                    self.created_medias.append(media)
-                    self.log.info("'%s' has created" % path)
-                else:
-                    self.added_medias.append(media)
-                    self.log.info("'%s' has added" % path)
-                f.create()
+            folders.setdefault(media.folder, []).append(media)
+        for folder, folder_medias in folders.iteritems():
+            self.sync_folder(folder, folder_medias, verify)
+        self.remove_other_folders(folders.keys(), verify)
+        self.log_summary()
+
+    @property
+    def updated_folders(self):
+        """
+        :return: Folders with created, added or updated files (including .nfo ones)
+        """
+        return set(clean_filename(m.folder) for m in self.created_medias + self.added_medias + self.updated_medias) | \
+            set(p.split(os.sep, 1)[0] for p in self.updated_nfo_files)
+
+    @property
+    def cleaned_folders(self):
+        """
+        :return: Folders (or top level files) which files were removed
+        """
+        base_path = decode_fs(self.encoded_path)
+        return set(os.path.relpath(f, base_path).split(os.sep, 1)[0] for f in self.removed_files)
 
-        self._remove_unwanted_files(all_files)
+    def log_summary(self):
         self.log.info('Library sync finished (%d file(s) created, %d added, %d updated, %d removed)',
                       len(self.created_medias), len(self.added_medias), len(self.updated_medias),
                       len(self.removed_files))
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
-from support.common import singleton
+import copy
+import time
+
+from support.common import singleton, keep_stored
 from support.plugin import plugin
 from support.torrent import TorrentClient, TorrentStream
 
@@ -117,23 +120,111 @@ def torrent_stream():
     return stream()
 
 
+PROXY_LIST_TTL = 3 * 24 * 60 * 60
+
+
+@singleton
+def telemetry():
+    """
+    :rtype : Telemetry
+    """
+    from support.telemetry import Telemetry
+
+    result = keep_stored('http_telemetry', plugin.get_storage().setdefault('http_telemetry', Telemetry()))
+    result.purge()
+    started = time.time()
+
+    def log_summary():
+        for line in result.format_summary(since=started):
+            plugin.log.debug("HTTP telemetry: %s" % line)
+
+    plugin.on_close(log_summary)
+    return result
+
+
+# the proxy list as it was last synced with the storage
+_synced_proxy_list = []
+
+
+@singleton
 def proxy_list():
+    """
+    Proxy list held by this process. Storages are reopened on every service iteration and the plugin may write
+    the list as well, so instead of a fresh copy from the storage the same list is returned each time and it's
+    kept in sync with the stored one (see sync_proxy_list).
+    """
     from support.hideme import HideMeProxyList, Proxy, SortBy, Anonymity
 
-    storage = plugin.get_storage()
     proxies = HideMeProxyList(types=[Proxy.HTTP], except_countries=['RU'], sort_by=SortBy.PING,
                               anonymity=[Anonymity.LOW, Anonymity.AVG, Anonymity.HIGH])
-    return storage.setdefault('proxies', proxies, ttl=24 * 60 * 3)
+    # the list is never expired by the storage, service refreshes it in background (see refresh_proxy_list)
+    proxies = plugin.get_storage().setdefault('proxies', proxies)
+    telemetry().track(proxies.requests_session, 'hideme')
+    _synced_proxy_list.append(copy.deepcopy(proxies))
+    plugin.on_close(sync_proxy_list)
+    return proxies
+
+
+def sync_proxy_list():
+    """
+    Puts the held proxy list to the storage. If the stored list was refreshed by another process meanwhile
+    or this process didn't change its list since the last sync, the held list is updated from the stored one
+    instead of overwriting it.
+    """
+    from xbmcswift2 import Storage
+
+    proxies = proxy_list()
+    storage = plugin.get_storage()
+    # the storage is cached, so the current list is read through a separate connection
+    with Storage(storage.filename, tablename=storage.tablename) as disk:
+        stored = disk.get('proxies')
+    if stored is not None and (proxies == _synced_proxy_list[0] or
+                               (stored.loaded_at or 0) > (proxies.loaded_at or 0)):
+        proxies.update(stored)
+    storage['proxies'] = proxies
+    _synced_proxy_list[0] = copy.deepcopy(proxies)
+
 
+def refresh_proxy_list(ahead=12 * 60 * 60):
+    """
+    Reloads the stored proxy list if it's going to be older than PROXY_LIST_TTL in `ahead` seconds.
+    Current list is kept if the new one can't be loaded.
 
-def xrequests_session():
+    :return: True if the list was refreshed
+    """
+    sync_proxy_list()
+    proxies = proxy_list()
+    if proxies.age is not None and proxies.age < PROXY_LIST_TTL - ahead:
+        return False
+    plugin.log.info("Refreshing proxy list...")
+    proxies.refresh()
+    sync_proxy_list()
+    plugin.get_storage().sync()
+    return True
+
+
+def xrequests_session(max_workers=None):
+    """
+    :param max_workers: How many requests are going to be sent concurrently, connection pools are sized to that
+    """
+    from requests.adapters import DEFAULT_POOLSIZE
     from requests.packages.urllib3.util import Retry
-    from support.xrequests import Session
+    from support.xrequests import Session, HealthMonitor
+    from support.dnscache import DnsCache
 
     use_proxy = plugin.get_setting('use-proxy', int)
+    storage = plugin.get_storage()
+    # the session is held by the scraper singleton, see keep_stored
+    dns_cache = keep_stored('dns_cache', storage.setdefault('dns_cache', DnsCache()))
+    dns_cache.purge()
 
     session = Session(max_retries=Retry(total=2, status_forcelist=[500, 502, 503, 504], backoff_factor=0.3),
-                      timeout=5, proxy_list=proxy_list() if use_proxy else None)
+                      timeout=5, proxy_list=proxy_list() if use_proxy else None, proxy_pool_size=3,
+                      pool_maxsize=max(max_workers or 0, DEFAULT_POOLSIZE),
+                      hedge=plugin.get_setting('hedge-requests', bool),
+                      hedge_workers=2 * max(max_workers or 0, DEFAULT_POOLSIZE),
+                      health=keep_stored('host_health', storage.setdefault('host_health', HealthMonitor())),
+                      dns_cache=dns_cache, telemetry=telemetry())
 
     # noinspection PyUnusedLocal,PyShadowingNames
     def always_use_proxy(request, response):
@@ -146,9 +237,12 @@ def xrequests_session():
 
 
 def torrent(url=None, data=None, file_name=None):
+    import requests
     from support.torrent import Torrent
 
-    return Torrent(url, data, file_name)
+    session = requests.Session()
+    telemetry().track(session, 'torrent')
+    return Torrent(url, data, file_name, session)
 
 
 @singleton
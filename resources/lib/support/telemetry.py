@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+import re
+import time
+import logging
+import threading
+
+from bisect import bisect_left
+from urlparse import urlparse
+
+# upper bounds (in seconds) of latency histogram buckets, the last bucket is unbounded
+LATENCY_BOUNDS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+
+
+def response_size(response):
+    """
+    :return: Size of the response body, as far as it's known without reading the stream
+    """
+    # noinspection PyProtectedMember
+    content = response._content
+    if content:
+        return len(content)
+    try:
+        return int(response.headers.get('Content-Length', 0))
+    except ValueError:
+        return 0
+
+
+def _new_stats():
+    return {
+        'requests': 0,
+        'errors': 0,
+        'bytes': 0,
+        'retries': 0,
+        'time': 0.0,
+        'latency': [0] * (len(LATENCY_BOUNDS) + 1),
+        # proxy address -> number of requests
+        'proxies': {},
+        # hedged, discovered, coalesced or error name -> number of requests
+        'outcomes': {},
+    }
+
+
+class Telemetry(object):
+    """
+    HTTP request statistics per endpoint (URL pattern) in hourly buckets of a rolling window.
+    Picklable, so it can be persisted between plugin invocations.
+
+    Endpoints are registered by the code which knows the URLs with `add_endpoint`, requests to other URLs are
+    accounted per host. Xrequests sessions report to telemetry by themselves, plain requests sessions can be
+    tracked with `track`, though only successful requests are recorded for them.
+    """
+    unpickable_properties = ['_lock', '_endpoints', 'log']
+
+    def __init__(self, window=48, bucket_size=60 * 60):
+        """
+        :param window: How many buckets to keep
+        :param bucket_size: Bucket duration in seconds
+        """
+        self.window = window
+        self.bucket_size = bucket_size
+        # bucket start time -> endpoint -> stats
+        self._buckets = {}
+        self._lock = threading.RLock()
+        self._endpoints = []
+        self.log = logging.getLogger(__name__)
+
+    def __getstate__(self):
+        result = self.__dict__.copy()
+        for p in self.unpickable_properties:
+            del result[p]
+        return result
+
+    def __setstate__(self, _dict):
+        self.__dict__ = _dict
+        self._lock = threading.RLock()
+        self._endpoints = []
+        self.log = logging.getLogger(__name__)
+
+    def __eq__(self, other):
+        return isinstance(other, Telemetry) and self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def add_endpoint(self, name, pattern):
+        """
+        :param pattern: Regular expression searched in request URLs, endpoints are checked in order of addition
+        """
+        with self._lock:
+            if name not in (n for n, _ in self._endpoints):
+                self._endpoints.append((name, re.compile(pattern)))
+
+    def endpoint(self, url):
+        for name, pattern in self._endpoints:
+            if pattern.search(url):
+                return name
+        return urlparse(url).hostname or url
+
+    def _stats(self, endpoint, now=None):
+        bucket = int((now or time.time()) // self.bucket_size * self.bucket_size)
+        if bucket not in self._buckets:
+            self._buckets[bucket] = {}
+            self.purge()
+        return self._buckets[bucket].setdefault(endpoint, _new_stats())
+
+    def record(self, url, elapsed, size=0, proxy=None, outcome=None, error=None, endpoint=None):
+        """
+        :param proxy: Proxy the request was sent through
+        :param outcome: How the response was obtained, if not by a plain request (hedged, coalesced, ...)
+        :param error: Exception the request failed with
+        """
+        endpoint = endpoint or self.endpoint(url)
+        if error is not None:
+            outcome = type(error).__name__
+        with self._lock:
+            stats = self._stats(endpoint)
+            stats['requests'] += 1
+            stats['time'] += elapsed
+            stats['bytes'] += size
+            stats['latency'][bisect_left(LATENCY_BOUNDS, elapsed)] += 1
+            if error is not None:
+                stats['errors'] += 1
+            if proxy is not None:
+                address = "%s:%s" % (proxy.ip, proxy.port)
+                stats['proxies'][address] = stats['proxies'].get(address, 0) + 1
+            if outcome:
+                stats['outcomes'][outcome] = stats['outcomes'].get(outcome, 0) + 1
+
+    def record_retry(self, url):
+        with self._lock:
+            self._stats(self.endpoint(url))['retries'] += 1
+
+    def track(self, session, endpoint=None):
+        """
+        Records successful requests of plain requests session
+
+        :type session: requests.Session
+        :param endpoint: Endpoint to account all requests of the session to
+        """
+        if getattr(session, 'telemetry', None) is self:
+            return
+
+        # noinspection PyUnusedLocal
+        def record_response(response, stream=False, **kwargs):
+            size = len(response.content) if not stream else response_size(response)
+            self.record(response.url, response.elapsed.total_seconds(), size, endpoint=endpoint)
+
+        session.telemetry = self
+        session.hooks['response'].append(record_response)
+
+    def purge(self):
+        with self._lock:
+            oldest = time.time() - self.window * self.bucket_size
+            for bucket in [b for b in self._buckets if b < oldest]:
+                del self._buckets[bucket]
+
+    def summary(self, since=None):
+        """
+        Aggregated statistics per endpoint over the window (or since the given time), endpoints with the most
+        total time go first
+
+        :rtype : list[dict]
+        """
+        result = {}
+        with self._lock:
+            for bucket, endpoints in self._buckets.iteritems():
+                if since is not None and bucket + self.bucket_size <= since:
+                    continue
+                for endpoint, stats in endpoints.iteritems():
+                    total = result.setdefault(endpoint, dict(_new_stats(), endpoint=endpoint))
+                    for key in ('requests', 'errors', 'bytes', 'retries', 'time'):
+                        total[key] += stats[key]
+                    total['latency'] = [a + b for a, b in zip(total['latency'], stats['latency'])]
+                    for key in ('proxies', 'outcomes'):
+                        for k, v in stats[key].iteritems():
+                            total[key][k] = total[key].get(k, 0) + v
+        for total in result.itervalues():
+            total['p50'] = self.percentile(total['latency'], 50)
+            total['p95'] = self.percentile(total['latency'], 95)
+        return sorted(result.values(), key=lambda s: s['time'], reverse=True)
+
+    @staticmethod
+    def percentile(histogram, percent):
+        """
+        :return: Upper bound of the histogram bucket where the percentile falls, inf if it's the unbounded one
+                 and None if the histogram is empty
+        """
+        count = sum(histogram)
+        if not count:
+            return None
+        rank = count * percent / 100.0
+        seen = 0
+        for i, n in enumerate(histogram):
+            seen += n
+            if seen >= rank and n:
+                return LATENCY_BOUNDS[i] if i < len(LATENCY_BOUNDS) else float('inf')
+        return None
+
+    def format_summary(self, since=None):
+        """
+        :rtype : list[str]
+        """
+        def bound(value):
+            if value is None:
+                return "-"
+            return "%gs" % value if value != float('inf') else ">%gs" % LATENCY_BOUNDS[-1]
+
+        lines = []
+        for s in self.summary(since):
+            line = "%s: %d request(s), %d error(s), %d retries, %.1fs total, p50 %s, p95 %s, %d kB" % \
+                   (s['endpoint'], s['requests'], s['errors'], s['retries'], s['time'], bound(s['p50']),
+                    bound(s['p95']), s['bytes'] / 1024)
+            if s['proxies']:
+                line += ", %d via %d proxies" % (sum(s['proxies'].values()), len(s['proxies']))
+            if s['outcomes']:
+                line += ", " + ", ".join("%s: %d" % o for o in sorted(s['outcomes'].items()))
+            lines.append(line)
+        return lines
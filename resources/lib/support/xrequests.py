@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import time
 import logging
 import threading
 import requests
@@ -6,11 +7,20 @@ import requests
 # noinspection PyPep8Naming
 from socket import timeout as SocketTimeout
 from requests.packages.urllib3.connection import BaseSSLError
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.packages.urllib3.exceptions import MaxRetryError, ResponseError
+from requests.packages.urllib3.util import Retry
+from collections import namedtuple, OrderedDict, Counter, deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from concurrent.futures._base import WrappedException
 from requests import adapters, RequestException
+from requests.cookies import RequestsCookieJar
+from support.dnscache import CachedDnsPoolManager
+from support.telemetry import response_size
 from urlparse import urlparse
 
 DEFAULT_PROXY_TRIES = 20
+DEFAULT_HEDGE_DELAY = 1.0
 
 
 class XRequestsException(RequestException):
@@ -25,6 +35,14 @@ class ProxyAlreadyFound(XRequestsException):
     pass
 
 
+class CircuitOpen(XRequestsException):
+    def __init__(self, host, retry_after, *args, **kwargs):
+        self.host = host
+        self.retry_after = retry_after
+        message = "Host %s is unavailable, next try in %.1f sec." % (host, retry_after)
+        super(CircuitOpen, self).__init__(message, *args, **kwargs)
+
+
 class ProxyInvalid(XRequestsException):
     def __init__(self, message, *args, **kwargs):
         self.proxy = kwargs.pop('proxy', None)
@@ -32,17 +50,428 @@ class ProxyInvalid(XRequestsException):
         super(ProxyInvalid, self).__init__(message, *args, **kwargs)
 
 
+ProxyFound = namedtuple('ProxyFound', ['proxy', 'request', 'response'])
+
+
+class ProxyProbe(object):
+    """
+    Cheap request used to qualify proxy candidates instead of sending them the real request. The response is
+    streamed and the connection is dropped as soon as the marker is seen, so a candidate transfers only the head
+    of the page.
+    """
+
+    def __init__(self, url, marker=None, max_bytes=None, chunk_size=4096):
+        """
+        :param url: URL to probe, should be small or have the marker close to the beginning
+        :param marker: byte string expected in the response body, only status is checked if omitted
+        :param max_bytes: give up after reading this much without finding the marker
+        """
+        self.url = url
+        self.marker = marker
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+
+    def check(self, proxy, response):
+        """
+        Reads the response until the marker is found
+
+        :raise ProxyInvalid: if the response doesn't look right
+        """
+        try:
+            if response.status_code != 200:
+                raise ProxyInvalid("Probe returned status %d" % response.status_code, proxy=proxy,
+                                   response=response)
+            if not self.marker:
+                return
+            read = 0
+            tail = b''
+            for chunk in response.iter_content(self.chunk_size):
+                # keep the tail of the previous chunk in case the marker is split between chunks
+                data = tail + chunk
+                if self.marker in data:
+                    return
+                read += len(chunk)
+                if self.max_bytes and read >= self.max_bytes:
+                    break
+                tail = data[-len(self.marker) + 1:]
+            raise ProxyInvalid("Probe response doesn't contain %r" % self.marker, proxy=proxy, response=response)
+        finally:
+            response.close()
+
+
+class ProxySearch(object):
+    def __init__(self, request, args, tries):
+        self.request = request
+        # arguments of the candidate tasks
+        self.args = args
+        self.future = Future()
+        self.tasks = []
+        self.pending = 0
+        self.tries_left = tries
+        self.wave = 0
+
+
+class ProxyDiscovery(object):
+    """
+    Looks for valid proxy racing several candidates on a persistent thread pool. Only one search is running at
+    a time, all concurrent callers subscribe to it and get the winner through the same future.
+
+    Candidates come ranked from the proxy list, so the best ones are tried first and the race is widened (doubled)
+    only when all candidates of the previous wave failed.
+    """
+    FIRST_WAVE = 2
+
+    def __init__(self, adapter, max_workers):
+        """
+        :type adapter: HTTPAdapter
+        """
+        self.adapter = adapter
+        self.log = logging.getLogger(__name__)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.RLock()
+        self._search = None
+
+    @property
+    def searching(self):
+        return self._search is not None
+
+    def discover(self, request, stream=False, timeout=None, verify=True, cert=None):
+        """
+        Starts new search or subscribes to the running one.
+
+        :return: Future resolving to ProxyFound, which response belongs to the request of the caller started
+                 the search
+        :rtype : Future
+        """
+        with self._lock:
+            search = self._search
+            if search is None:
+                self.log.info("Looking for valid proxy...")
+                search = self._search = ProxySearch(request, (request, stream, timeout, verify, cert),
+                                                    self.adapter.session.proxy_tries)
+                self._next_wave(search)
+            return search.future
+
+    def _next_wave(self, search):
+        with self._lock:
+            search.wave = min(2 * search.wave or self.FIRST_WAVE, search.tries_left)
+            search.tries_left -= search.wave
+            tasks = [self.executor.submit(self._try_proxy, search, *search.args) for _ in range(search.wave)]
+            search.tasks.extend(tasks)
+            search.pending += len(tasks)
+            # a task which is already done calls back right away and may finish the search
+            for task in tasks:
+                task.add_done_callback(partial(self._task_done, search))
+
+    def _try_proxy(self, search, request, stream, timeout, verify, cert):
+        if search.future.done():
+            raise ProxyAlreadyFound()
+        return self.adapter.try_proxy(request, stream, timeout, verify, cert)
+
+    def _task_done(self, search, task):
+        with self._lock:
+            search.pending -= 1
+            if not task.cancelled():
+                try:
+                    proxy, response = task.result()
+                except requests.RequestException as e:
+                    self.log.debug(e)
+                except Exception as e:
+                    if not search.future.done():
+                        search.future.set_exception(WrappedException(e))
+                else:
+                    if not search.future.done():
+                        search.future.set_result(ProxyFound(proxy, search.request, response))
+                        # the rest of candidates are not needed anymore
+                        for t in search.tasks:
+                            t.cancel()
+                    elif response is not None:
+                        response.close()
+            if not search.pending and not search.future.done() and search.tries_left:
+                self.log.debug("Proxy candidates failed, trying %d more..." % min(2 * search.wave, search.tries_left))
+                self._next_wave(search)
+            elif not search.pending and not search.future.done():
+                self.log.info("No valid proxies found.")
+                search.future.set_exception(WrappedException(NoValidProxiesFound(request=search.request)))
+            if search.future.done() and self._search is search:
+                self._search = None
+
+
+class HostHealth(object):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, retry_tokens):
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.retry_tokens = retry_tokens
+        # start time of the trial request of half-open circuit
+        self.trial_started = None
+
+    def __eq__(self, other):
+        return isinstance(other, HostHealth) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "HostHealth(%s, failures=%d, retry_tokens=%.1f)" % (self.state, self.consecutive_failures,
+                                                                  self.retry_tokens)
+
+
+class HealthMonitor(object):
+    """
+    Keeps health of the hosts: circuit breaker which makes requests to a failing host fail fast and retry budget
+    which limits retries to the given share of requests. Picklable, so the state can survive plugin invocations.
+    """
+    unpickable_properties = ['_lock', 'log']
+
+    def __init__(self, failure_threshold=5, reset_timeout=60, retry_ratio=0.2, retry_burst=5):
+        """
+        :param failure_threshold: Open circuit after that many consecutive failures
+        :param reset_timeout: Seconds to wait before letting a trial request through the open circuit
+        :param retry_ratio: Retries allowed per request
+        :param retry_burst: Max retries to accumulate
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.retry_ratio = retry_ratio
+        self.retry_burst = retry_burst
+        self._hosts = {}
+        self._lock = threading.RLock()
+        self.log = logging.getLogger(__name__)
+
+    def __getstate__(self):
+        result = self.__dict__.copy()
+        for p in self.unpickable_properties:
+            del result[p]
+        return result
+
+    def __setstate__(self, _dict):
+        self.__dict__ = _dict
+        self._lock = threading.RLock()
+        self.log = logging.getLogger(__name__)
+        # trial requests of the previous invocation are over
+        for health in self._hosts.itervalues():
+            health.trial_started = None
+
+    def __eq__(self, other):
+        return isinstance(other, HealthMonitor) and self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def host(self, host):
+        """
+        :rtype : HostHealth
+        """
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = HostHealth(float(self.retry_burst))
+            return self._hosts[host]
+
+    def before_request(self, host):
+        """
+        :raise CircuitOpen: if the request shouldn't be sent
+        """
+        with self._lock:
+            health = self.host(host)
+            if health.state != HostHealth.CLOSED:
+                now = time.time()
+                retry_after = health.opened_at + self.reset_timeout - now
+                if health.state == HostHealth.OPEN and retry_after <= 0:
+                    self.log.info("Trying to reach %s again..." % host)
+                    health.state = HostHealth.HALF_OPEN
+                # let the next trial through if the previous one has been lost somewhere
+                if health.state == HostHealth.OPEN or \
+                        health.trial_started is not None and now - health.trial_started <= self.reset_timeout:
+                    raise CircuitOpen(host, max(retry_after, 0))
+                health.trial_started = now
+            health.retry_tokens = min(self.retry_burst, health.retry_tokens + self.retry_ratio)
+
+    def report_success(self, host):
+        with self._lock:
+            health = self.host(host)
+            if health.state != HostHealth.CLOSED:
+                self.log.info("Host %s is available again" % host)
+            health.state = HostHealth.CLOSED
+            health.consecutive_failures = 0
+            health.trial_started = None
+
+    def report_failure(self, host):
+        with self._lock:
+            health = self.host(host)
+            health.consecutive_failures += 1
+            if health.state == HostHealth.HALF_OPEN or \
+                    health.state == HostHealth.CLOSED and health.consecutive_failures >= self.failure_threshold:
+                self.log.warn("Host %s is unavailable, failing fast for %d sec." % (host, self.reset_timeout))
+                health.state = HostHealth.OPEN
+                health.opened_at = time.time()
+            health.trial_started = None
+
+    def withdraw_retry(self, host):
+        with self._lock:
+            health = self.host(host)
+            if health.retry_tokens < 1:
+                return False
+            health.retry_tokens -= 1
+            return True
+
+
+class BudgetedRetry(Retry):
+    """
+    Retry which spends retry budget of the host, so that retries don't multiply the load on a failing host,
+    and reports retries to telemetry
+    """
+
+    def __init__(self, total=10, health=None, telemetry=None, **kwargs):
+        """
+        :type health: HealthMonitor
+        :type telemetry: Telemetry
+        """
+        super(BudgetedRetry, self).__init__(total, **kwargs)
+        self.health = health
+        self.telemetry = telemetry
+
+    @classmethod
+    def from_retry(cls, retry, health, telemetry=None):
+        return cls(total=retry.total, connect=retry.connect, read=retry.read, redirect=retry.redirect,
+                   method_whitelist=retry.method_whitelist, status_forcelist=retry.status_forcelist,
+                   backoff_factor=retry.backoff_factor, raise_on_redirect=retry.raise_on_redirect, health=health,
+                   telemetry=telemetry)
+
+    def new(self, **kw):
+        kw.setdefault('health', self.health)
+        kw.setdefault('telemetry', self.telemetry)
+        return super(BudgetedRetry, self).new(**kw)
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        new_retry = super(BudgetedRetry, self).increment(method, url, response, error, _pool, _stacktrace)
+        if self.telemetry and _pool and url:
+            # requests sent through a proxy have absolute URLs
+            self.telemetry.record_retry(url if '://' in url else "%s://%s%s" % (_pool.scheme, _pool.host, url))
+        if self.health and _pool and not self.health.withdraw_retry(_pool.host):
+            raise MaxRetryError(_pool, url, error or ResponseError("retry budget of the host is exhausted"))
+        return new_retry
+
+
+class LatencyTracker(object):
+    """
+    Keeps response times of recent requests per host
+    """
+
+    def __init__(self, window=100, min_samples=10):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def add(self, host, latency):
+        with self._lock:
+            self._samples.setdefault(host, deque(maxlen=self.window)).append(latency)
+
+    def percentile(self, host, percent):
+        """
+        :return: Response time in seconds or None if there are not enough samples for the host yet
+        """
+        with self._lock:
+            samples = sorted(self._samples.get(host, []))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(int(len(samples) * percent / 100.0), len(samples) - 1)]
+
+
+class HedgeBudget(object):
+    """
+    Token bucket limiting hedged requests to the given share of all requests
+    """
+
+    def __init__(self, ratio=0.1, burst=3):
+        self.ratio = ratio
+        self.burst = burst
+        self._tokens = float(burst)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class VersionedCookieJar(RequestsCookieJar):
+    """
+    Cookie jar which counts its modifications, so it's cheap to tell whether it has to be saved
+    """
+    def __init__(self, policy=None):
+        super(VersionedCookieJar, self).__init__(policy)
+        self.version = 0
+
+    def set_cookie(self, cookie, *args, **kwargs):
+        self.version += 1
+        return super(VersionedCookieJar, self).set_cookie(cookie, *args, **kwargs)
+
+    def clear(self, domain=None, path=None, name=None):
+        self.version += 1
+        return super(VersionedCookieJar, self).clear(domain, path, name)
+
+    def copy(self):
+        new_cj = VersionedCookieJar()
+        new_cj.update(self)
+        return new_cj
+
+
 class Session(requests.Session):
 
     def __init__(self, timeout=None, max_retries=adapters.DEFAULT_RETRIES, proxy_list=None,
-                 proxy_tries=DEFAULT_PROXY_TRIES, **adapter_params):
+                 proxy_tries=DEFAULT_PROXY_TRIES, proxy_probe=None, hedge=False, hedge_percentile=95,
+                 hedge_delay=DEFAULT_HEDGE_DELAY, hedge_budget=0.1, hedge_workers=2 * adapters.DEFAULT_POOLSIZE,
+                 health=None, dns_cache=None, telemetry=None, **adapter_params):
+        """
+        :type proxy_probe: ProxyProbe
+        :param proxy_probe: If set, proxy candidates are qualified with the probe and the real request is sent
+                            only through the winner
+        :param hedge: If set, GET request which is not answered in time is duplicated and the first response
+                      is used
+        :param hedge_percentile: Percentile of recent response times of the host to wait before hedging
+        :param hedge_delay: Seconds to wait before hedging while there are not enough samples for the host
+        :param hedge_budget: Max share of requests which are allowed to be hedged
+        :param hedge_workers: Max number of hedged requests in flight, including the original ones
+        :type health: HealthMonitor
+        :param health: If set, requests to failing hosts fail fast and their retries are limited
+        :type dns_cache: DnsCache
+        :param dns_cache: If set, host names are resolved through the cache
+        :type telemetry: Telemetry
+        :param telemetry: If set, requests are recorded there
+        """
         super(Session, self).__init__()
 
+        self.cookies = VersionedCookieJar()
         self.timeout = timeout
         self.proxy_list = proxy_list
         self.proxy_tries = proxy_tries
+        self.proxy_probe = proxy_probe
         self.proxy_validators = []
         self.proxy_need_checks = []
+        self.health = health
+        self.dns_cache = dns_cache
+        self.telemetry = telemetry
+        self.log = logging.getLogger(__name__)
+
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.hedge_budget = HedgeBudget(hedge_budget)
+        self.latencies = LatencyTracker()
+        self._hedge_executor = ThreadPoolExecutor(max_workers=hedge_workers) if hedge else None
+        self._local = threading.local()
 
         adapter = HTTPAdapter(max_retries=max_retries, session=self, **adapter_params)
         self.mount('http://', adapter)
@@ -69,34 +498,320 @@ class Session(requests.Session):
                 return True
         return False
 
+    def preconnect(self, urls):
+        """
+        Opens keep-alive connections to the hosts of URLs in background, so that the first requests don't wait
+        for DNS and TCP connection setup. Hosts which are going to be reached through a proxy are skipped.
+        """
+        def connect():
+            for url in urls:
+                if self.proxy_list and self.is_proxy_needed(self.prepare_request(requests.Request('GET', url))):
+                    continue
+                try:
+                    self.get_adapter(url).preconnect(url)
+                    self.log.debug("Connected to %s in advance" % url)
+                except Exception as e:
+                    self.log.debug("Can't connect to %s in advance: %s" % (url, e))
+
+        thread = threading.Thread(target=connect, name="Preconnect")
+        thread.daemon = True
+        thread.start()
+
+    def _attempt(self, host, request, kwargs):
+        # redirects are sent from within the attempt, they shouldn't be hedged on their own
+        self._local.attempt = True
+        try:
+            start = time.time()
+            response = super(Session, self).send(request, **kwargs)
+            self.latencies.add(host, time.time() - start)
+            return response
+        finally:
+            self._local.attempt = False
+
+    @staticmethod
+    def _discard(attempt):
+        def close_response(future):
+            try:
+                future.result().close()
+            except Exception:
+                pass
+
+        if not attempt.cancel():
+            attempt.add_done_callback(close_response)
+
+    def send(self, request, **kwargs):
+        telemetry = self.telemetry
+        # redirects and hedged attempts are accounted to the original request
+        if not telemetry or getattr(self._local, 'recording', False) or getattr(self._local, 'attempt', False):
+            return self._send_hedged(request, **kwargs)
+        self._local.recording = True
+        start = time.time()
+        try:
+            response = self._send_hedged(request, **kwargs)
+        except Exception as e:
+            telemetry.record(request.url, time.time() - start, error=e)
+            raise
+        finally:
+            self._local.recording = False
+        telemetry.record(request.url, time.time() - start, response_size(response),
+                         proxy=getattr(response, 'proxy', None), outcome=getattr(response, 'outcome', None))
+        return response
+
+    def _send_hedged(self, request, **kwargs):
+        if not self.hedge or request.method != 'GET' or kwargs.get('stream') or getattr(self._local, 'attempt', False):
+            return super(Session, self).send(request, **kwargs)
+
+        host = urlparse(request.url).netloc
+        self.hedge_budget.deposit()
+        delay = self.latencies.percentile(host, self.hedge_percentile) or self.hedge_delay
+        primary = self._hedge_executor.submit(self._attempt, host, request, dict(kwargs))
+        wait([primary], timeout=delay)
+        if primary.done() or not self.hedge_budget.withdraw():
+            return primary.result()
+
+        self.log.debug("No response from %s in %.2fs, hedging %s" % (host, delay, request.url))
+        hedged = self._hedge_executor.submit(self._attempt, host, request.copy(), dict(kwargs))
+        pending = [primary, hedged]
+        response = None
+        while pending and response is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for attempt in sorted(done, key=lambda f: f is not primary):
+                try:
+                    result = attempt.result()
+                except Exception as e:
+                    self.log.debug("Hedged attempt failed: %s" % e)
+                    continue
+                if response is None:
+                    response = result
+                else:
+                    result.close()
+        if response is None:
+            # both attempts failed, the error of the original one is more relevant
+            return primary.result()
+        for attempt in pending:
+            self._discard(attempt)
+        response.outcome = 'hedged'
+        return response
+
+
+def pool_stats(pool):
+    """
+    Connection statistics of urllib3 connection pool: number of requests, opened connections, reused connections
+    and connections thrown away instead of being returned to the pool (e.g. when the pool was full).
+    """
+    idle = pool.pool.queue if pool.pool is not None else []
+    connections = pool.num_connections
+    return Counter(requests=pool.num_requests, connections=connections,
+                   reused=max(pool.num_requests - connections, 0),
+                   discarded=max(connections - sum(1 for c in idle if c), 0))
+
 
 class HTTPAdapter(adapters.HTTPAdapter):
     def __init__(self, session, pool_connections=adapters.DEFAULT_POOLSIZE,
                  pool_maxsize=adapters.DEFAULT_POOLSIZE, max_retries=adapters.DEFAULT_RETRIES,
-                 pool_block=adapters.DEFAULT_POOLBLOCK, debug_headers=False):
+                 pool_block=adapters.DEFAULT_POOLBLOCK, debug_headers=False, proxy_pool_size=1,
+                 max_proxy_managers=adapters.DEFAULT_POOLSIZE):
         """
         :type session: Session
+        :param pool_maxsize: How many connections to keep per host, should match the number of concurrent requests
+        :param proxy_pool_size: How many validated proxies to keep for spreading requests across them
+        :param max_proxy_managers: How many proxy managers (connection pools of different proxies) to keep,
+                                   the least recently used ones are closed
         """
-        super(HTTPAdapter, self).__init__(pool_connections, pool_maxsize, max_retries, pool_block)
         self.session = session
+        self._stats_lock = threading.Lock()
+        # statistics of already closed connection pools
+        self._closed_pools_stats = Counter()
+        super(HTTPAdapter, self).__init__(pool_connections, pool_maxsize, max_retries, pool_block)
+        if (session.health or session.telemetry) and not isinstance(self.max_retries, BudgetedRetry):
+            self.max_retries = BudgetedRetry.from_retry(self.max_retries, session.health, session.telemetry)
+        self.proxy_manager = OrderedDict()
+        self.max_proxy_managers = max_proxy_managers
+        self._managers_lock = threading.RLock()
         self.debug_headers = debug_headers
+        self.proxy_pool_size = proxy_pool_size
         self.log = logging.getLogger(__name__)
-        self._lock = threading.Lock()
+        self.discovery = ProxyDiscovery(self, max_workers=session.proxy_tries / 2)
+        self._pool_lock = threading.RLock()
+        # validated proxy -> number of requests currently sent through it
+        self._proxy_pool = {}
+
+    def init_poolmanager(self, connections, maxsize, block=adapters.DEFAULT_POOLBLOCK, **pool_kwargs):
+        dns_cache = self.session.dns_cache
+        if dns_cache is not None:
+            self._pool_connections = connections
+            self._pool_maxsize = maxsize
+            self._pool_block = block
+            self.poolmanager = CachedDnsPoolManager(num_pools=connections, maxsize=maxsize, block=block, strict=True,
+                                                    dns_cache=dns_cache, **pool_kwargs)
+        else:
+            super(HTTPAdapter, self).init_poolmanager(connections, maxsize, block, **pool_kwargs)
+        self.poolmanager.pools.dispose_func = self._dispose_pool
+
+    def preconnect(self, url):
+        """
+        Opens a connection to the host of the URL and puts it to the pool
+        """
+        pool = self.poolmanager.connection_from_url(url)
+        self.cert_verify(pool, url, True, None)
+        # noinspection PyProtectedMember
+        conn = pool._get_conn()
+        if not conn.sock:
+            conn.connect()
+        # noinspection PyProtectedMember
+        pool._put_conn(conn)
+
+    def _dispose_pool(self, pool):
+        with self._stats_lock:
+            self._closed_pools_stats.update(pool_stats(pool))
+        pool.close()
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        with self._managers_lock:
+            manager = super(HTTPAdapter, self).proxy_manager_for(proxy, **proxy_kwargs)
+            manager.pools.dispose_func = self._dispose_pool
+            # mark as the most recently used one
+            self.proxy_manager[proxy] = self.proxy_manager.pop(proxy)
+            while len(self.proxy_manager) > self.max_proxy_managers:
+                _, evicted = self.proxy_manager.popitem(last=False)
+                evicted.clear()
+            return manager
+
+    def connection_stats(self):
+        """
+        Connection statistics of all pools, including closed ones
 
-    def _try_proxy(self, request, stream, timeout, verify, cert):
+        :rtype : Counter
+        """
+        with self._managers_lock:
+            managers = [self.poolmanager] + self.proxy_manager.values()
+        with self._stats_lock:
+            stats = Counter(self._closed_pools_stats)
+        for manager in managers:
+            with manager.pools.lock:
+                pools = manager.pools._container.values()
+            for pool in pools:
+                stats.update(pool_stats(pool))
+        return stats
+
+    def close(self):
+        self.log.debug("Connection stats: %s" % dict(self.connection_stats()))
+        with self._managers_lock:
+            for manager in self.proxy_manager.values():
+                manager.clear()
+            self.proxy_manager.clear()
+        super(HTTPAdapter, self).close()
+
+    def _acquire_proxy(self):
+        """
+        Returns the least loaded proxy from the pool and increases its load
+        """
+        with self._pool_lock:
+            last_good_proxy = self.session.proxy_list.last_good_proxy
+            if not self._proxy_pool and last_good_proxy:
+                self._proxy_pool[last_good_proxy] = 0
+            if not self._proxy_pool:
+                return None
+            proxy = min(self._proxy_pool, key=self._proxy_pool.get)
+            self._proxy_pool[proxy] += 1
+            return proxy
+
+    def _release_proxy(self, proxy, failed=False):
+        with self._pool_lock:
+            if proxy not in self._proxy_pool:
+                return
+            if not failed:
+                self._proxy_pool[proxy] -= 1
+                return
+            del self._proxy_pool[proxy]
+            proxy_list = self.session.proxy_list
+            if proxy_list.last_good_proxy == proxy:
+                proxy_list.last_good_proxy = next(iter(self._proxy_pool), None)
+
+    def _add_to_pool(self, proxy):
+        with self._pool_lock:
+            if proxy in self._proxy_pool or self._is_pool_full():
+                return
+            self.log.info("Found valid proxy: %r" % proxy)
+            self._proxy_pool[proxy] = 0
+            proxy_list = self.session.proxy_list
+            if not proxy_list.last_good_proxy:
+                proxy_list.last_good_proxy = proxy
+
+    def _is_pool_full(self):
+        with self._pool_lock:
+            return len(self._proxy_pool) >= self.proxy_pool_size
+
+    def try_proxy(self, request, stream, timeout, verify, cert):
+        """
+        Sends request (or the session proxy probe, if any) through the next proxy candidate and adds it to
+        the pool if succeeded
+
+        :return: tuple of proxy and response, response is None if the probe was used
+        """
         scheme = urlparse(request.url).scheme
         proxy_list = self.session.proxy_list
-        if proxy_list.last_good_proxy:
-            raise ProxyAlreadyFound()
-        proxy = proxy_list.get_proxy(scheme)
+        with self._pool_lock:
+            if self._is_pool_full():
+                raise ProxyAlreadyFound()
+            exclude = self._proxy_pool.keys()
+        proxy = proxy_list.get_proxy(scheme, exclude=exclude)
         self.log.debug('Trying %r...' % proxy)
-        response = self._send(request, stream, timeout, verify, cert, proxy.for_requests)
-        self.session.validate_proxy_response(proxy, request, response)
-        if not proxy_list.last_good_proxy:
-            self.log.info("Found valid proxy: %r" % proxy)
-            proxy_list.last_good_proxy = proxy
+        if self.session.proxy_probe:
+            response = None
+            self._probe_proxy(proxy, timeout, verify, cert)
+        else:
+            response = self._send_via_proxy(proxy, request, stream, timeout, verify, cert)
+        self._add_to_pool(proxy)
+        return proxy, response
+
+    def _top_up_pool(self, request, timeout, verify, cert):
+        """
+        Starts looking for more proxies in background if the pool is not full
+        """
+        if self.discovery.searching or self._is_pool_full() or request.method != 'GET':
+            return
+
+        def close_response(future):
+            try:
+                response = future.result().response
+            except Exception as e:
+                self.log.debug("Can't top up proxy pool: %s" % e)
+            else:
+                if response is not None:
+                    response.close()
+
+        self.discovery.discover(request.copy(), False, timeout, verify, cert).add_done_callback(close_response)
+
+    def _send_via_proxy(self, proxy, request, stream=False, timeout=None, verify=True, cert=None):
+        proxy_list = self.session.proxy_list
+        start = time.time()
+        try:
+            response = self._send(request, stream, timeout, verify, cert, proxy.for_requests)
+            self.session.validate_proxy_response(proxy, request, response)
+        except requests.RequestException:
+            proxy_list.report_failure(proxy)
+            raise
+        proxy_list.report_success(proxy, time.time() - start)
+        response.proxy = proxy
         return response
 
+    def _probe_proxy(self, proxy, timeout=None, verify=True, cert=None):
+        probe = self.session.proxy_probe
+        proxy_list = self.session.proxy_list
+        request = self.session.prepare_request(requests.Request('GET', probe.url))
+        start = time.time()
+        try:
+            response = self._send(request, True, timeout, verify, cert, proxy.for_requests)
+            probe.check(proxy, response)
+        except (SocketTimeout, BaseSSLError) as e:
+            proxy_list.report_failure(proxy)
+            raise requests.exceptions.ReadTimeout(e, request=request)
+        except requests.RequestException:
+            proxy_list.report_failure(proxy)
+            raise
+        proxy_list.report_success(proxy, time.time() - start)
+
     def _send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
         if self.debug_headers:
             self.log.debug("Request headers: %r" % request.headers)
@@ -111,41 +826,74 @@ class HTTPAdapter(adapters.HTTPAdapter):
         return response
 
     def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        if self.session.health:
+            self.session.health.before_request(urlparse(request.url).hostname)
+        return self._send_request(request, stream, timeout, verify, cert, proxies)
+
+    def _report_host_health(self, request, response=None):
+        """
+        Reports the outcome of a request to the host health. Only failures of the host itself count: no response
+        on a direct request or a server error, failing proxies don't make the host unavailable.
+
+        :param response: None if the host didn't respond to a direct request
+        """
+        health = self.session.health
+        if not health:
+            return
+        host = urlparse(request.url).hostname
+        if response is None or response.status_code >= 500:
+            health.report_failure(host)
+        else:
+            health.report_success(host)
+
+    def _send_request(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
         timeout = timeout or self.session.timeout
         proxy_list = self.session.proxy_list
 
         if not proxy_list or proxies or not self.session.is_proxy_needed(request):
-            response = self._send(request, stream, timeout, verify, cert, proxies)
+            try:
+                response = self._send(request, stream, timeout, verify, cert, proxies)
+            except requests.RequestException:
+                self._report_host_health(request)
+                raise
+            self._report_host_health(request, response)
             if not proxy_list or proxies or not self.session.is_proxy_needed(request, response):
                 return response
 
-        self._lock.acquire()
-        while proxy_list.last_good_proxy:
-            self._lock.release()
+        coalesced = False
+        discovered = False
+        # a proxy which passed discovery can still fail the real request, so attempts through the pool are
+        # limited both before and after the (single) discovery
+        max_attempts = attempts = max(self.proxy_pool_size, 1)
+        while True:
+            proxy = self._acquire_proxy()
+            if not proxy:
+                if discovered:
+                    raise NoValidProxiesFound(request=request)
+                discovered = True
+                attempts = max_attempts
+                found = self.discovery.discover(request, stream, timeout, verify, cert).result()
+                if found.request is request and found.response is not None:
+                    self._report_host_health(request, found.response)
+                    found.response.outcome = 'discovered'
+                    return found.response
+                # (re)play the request through the pool, where the winner is now
+                coalesced = coalesced or found.request is not request
+                continue
+            if not attempts:
+                self._release_proxy(proxy)
+                raise NoValidProxiesFound(request=request)
+            attempts -= 1
             try:
-                response = self._send(request, stream, timeout, verify, cert,
-                                      proxy_list.last_good_proxy.for_requests)
-                self.session.validate_proxy_response(proxy_list.last_good_proxy, request, response)
-                return response
+                response = self._send_via_proxy(proxy, request, stream, timeout, verify, cert)
             except requests.RequestException as e:
                 self.log.warn(e)
-                proxy_list.last_good_proxy = None
-            self._lock.acquire()
-
-        self.log.info("Looking for valid proxy...")
-        executor = ThreadPoolExecutor(max_workers=self.session.proxy_tries / 2)
-        futures = [executor.submit(self._try_proxy, request, stream, timeout, verify, cert)
-                   for _ in range(self.session.proxy_tries)]
-        try:
-            for future in as_completed(futures):
-                try:
-                    response = future.result()
-                    return response
-                except requests.RequestException as e:
-                    self.log.debug(e)
-                    pass
-        finally:
-            self._lock.release()
-            executor.shutdown(wait=False)
-        self.log.info("No valid proxies found.")
-        raise NoValidProxiesFound(request=request)
+                self._release_proxy(proxy, failed=True)
+                continue
+            self._release_proxy(proxy)
+            self._report_host_health(request, response)
+            self._top_up_pool(request, timeout, verify, cert)
+            if coalesced:
+                # the request waited for proxy discovery started by another one
+                response.outcome = 'coalesced'
+            return response
@@ -34,6 +34,7 @@ Special credit for Jan de Mooij that fixed the giflzw encoder."""
 
 import struct
 import math
+from array import array
 
 KNOWN_FORMATS = ('GIF87a', 'GIF89a')
 
@@ -372,6 +373,88 @@ class GifDecoder(Gif):
         return output
 
 
+def decode_image(data):
+    """Fast decoder for small images: decodes only the first image of the
+    file, palettes and extensions are skipped.
+    Returns tuple (width, height, array of pixel values)"""
+    try:
+        header, width, height, flags = struct.unpack_from('<6sHHB', data)
+        if header not in KNOWN_FORMATS:
+            raise ValueError("Not a GIF file")
+        pos = 13
+        if flags & 0x80:
+            pos += 3 << ((flags & 7) + 1)
+        while True:
+            block = ord(data[pos])
+            pos += 1
+            if block == Gif.IMAGE_SEPARATOR:
+                break
+            elif block == Gif.EXTENSION_INTRODUCER:
+                # skip label and data sub-blocks
+                pos += 1
+                while ord(data[pos]):
+                    pos += ord(data[pos]) + 1
+                pos += 1
+            else:
+                raise ValueError("No image found")
+        _, _, width, height, flags = struct.unpack_from(Gif.FMT_IMGDESC, data, pos)
+        pos += 9
+        if flags & 0x80:
+            pos += 3 << ((flags & 7) + 1)
+        codesize = ord(data[pos])
+        pos += 1
+        chunks = []
+        while ord(data[pos]):
+            size = ord(data[pos])
+            chunks.append(data[pos + 1:pos + 1 + size])
+            pos += size + 1
+    except (IndexError, struct.error):
+        raise ValueError("Truncated GIF file")
+    return width, height, lzw_decode(''.join(chunks), codesize)
+
+
+def lzw_decode(data, initial_codesize):
+    """Decodes a lzw stream keeping codes in an integer bit buffer
+    Returns array of pixel values"""
+    clearcode = 1 << initial_codesize
+    end_of_info = clearcode + 1
+    table = [chr(i) for i in xrange(clearcode)] + [None, None]
+    codesize = initial_codesize + 1
+    output = []
+    old = None
+    buf = bits = 0
+    for byte in bytearray(data):
+        buf |= byte << bits
+        bits += 8
+        while bits >= codesize:
+            code = buf & ((1 << codesize) - 1)
+            buf >>= codesize
+            bits -= codesize
+            if code == clearcode:
+                del table[end_of_info + 1:]
+                codesize = initial_codesize + 1
+                old = None
+                continue
+            elif code == end_of_info:
+                return array('B', ''.join(output))
+            if code < len(table):
+                c = table[code]
+                if c is None:
+                    raise ValueError("Invalid LZW code %d" % code)
+                if old is not None:
+                    table.append(old + c[0])
+            elif old is not None and code == len(table):
+                c = old + old[0]
+                table.append(c)
+            else:
+                raise ValueError("Invalid LZW code %d" % code)
+            output.append(c)
+            old = c
+            if len(table) == 1 << codesize and codesize < 12:
+                codesize += 1
+    return array('B', ''.join(output))
+
+
 class GifEncoder(Gif):
     """Encodes a *something* into a gif"""
 
@@ -18,9 +18,9 @@ except ImportError:
     from cgi import parse_qs
 
 from logger import log, setup_log
-from urls import UrlRule, NotFoundException, AmbiguousUrlException
+from urls import UrlRule, Router, NotFoundException, AmbiguousUrlException
 from xbmcswift2 import xbmc, xbmcaddon, Request, xbmcvfs
-from xbmcmixin import XBMCMixin
+from xbmcmixin import XBMCMixin, REVALIDATION_TIMEOUT
 
 
 class Plugin(XBMCMixin):
@@ -59,7 +59,10 @@ class Plugin(XBMCMixin):
     def __init__(self, name=None, addon_id=None, filepath=None, info_type=None):
         self._name = name
         self._routes = []
+        self._router = Router()
         self._view_functions = {}
+        # view function -> the first rule added for it
+        self._view_func_rules = {}
 
         # addon_id is no longer required as it can be parsed from addon.xml
         if addon_id:
@@ -95,6 +98,9 @@ class Plugin(XBMCMixin):
         # The plugin's named logger
         self._log = setup_log(self._addon_id)
 
+        # Functions to call when the plugin finishes the request
+        self._close_handlers = []
+
         # The path to the storage directory for the addon
         self._storage_path = self.addon_data_path(".storage/")
         from xbmcswift2.common import direxists
@@ -216,17 +222,17 @@ class Plugin(XBMCMixin):
         for func in module._register_funcs:
             func(self, url_prefix)
 
-    def cached_route(self, url_rule, name=None, options=None, ttl=None):
+    def cached_route(self, url_rule, name=None, options=None, ttl=None, stale_ttl=None):
         """A decorator to add a route to a view and also apply caching. The
         url_rule, name and options arguments are the same arguments for the
-        route function. The TTL argument if given will passed along to the
-        caching decorator.
+        route function. The TTL and stale TTL arguments if given will passed
+        along to the caching decorator.
         """
         route_decorator = self.route(url_rule, name=name, options=options)
         if ttl:
-            cache_decorator = self.cached(ttl)
+            cache_decorator = self.cached(ttl, stale_ttl)
         else:
-            cache_decorator = self.cached()
+            cache_decorator = self.cached(stale_ttl=stale_ttl)
 
         def new_decorator(func):
             return route_decorator(cache_decorator(func))
@@ -253,7 +259,7 @@ class Plugin(XBMCMixin):
         The route decorator provides the same functionality.
         """
         rule = UrlRule(url_rule, view_func, name, options)
-        if name in self._view_functions.keys():
+        if name in self._view_functions:
             # TODO: Raise exception for ambiguous views during registration
             log.warning('Cannot add url rule "%s" with name "%s". There is '
                         'already a view with that name', url_rule, name)
@@ -262,7 +268,9 @@ class Plugin(XBMCMixin):
             log.debug('Adding url rule "%s" named "%s" pointing to function '
                       '"%s"', url_rule, name, view_func.__name__)
             self._view_functions[name] = rule
+        self._view_func_rules.setdefault(view_func, rule)
         self._routes.append(rule)
+        self._router.add(rule)
 
     def url_for(self, endpoint, **items):
         """Returns a valid XBMC plugin URL for the given endpoint name.
@@ -277,8 +285,8 @@ class Plugin(XBMCMixin):
             rule = self._view_functions[endpoint]
         except KeyError:
             try:
-                rule = (rule for rule in self._view_functions.values() if rule.view_func == endpoint).next()
-            except StopIteration:
+                rule = self._view_func_rules[endpoint]
+            except (KeyError, TypeError):
                 raise NotFoundException(
                     '%s doesn\'t match any known patterns.' % endpoint)
 
@@ -289,29 +297,23 @@ class Plugin(XBMCMixin):
             # TODO: Make this a regular exception
             raise AmbiguousUrlException
 
-        pathqs = rule.make_path_qs(items)
-        return 'plugin://%s%s' % (self._addon_id, pathqs)
+        return 'plugin://' + self._addon_id + rule.make_path_qs(items)
 
     def _dispatch(self, path):
-        for rule in self._routes:
-            try:
-                view_func, items = rule.match(path)
-            except NotFoundException:
-                continue
-            log.info('Request for "%s" matches rule for function "%s"',
-                     path, view_func.__name__)
-            listitems = view_func(**items)
-            # Only call self.finish() for UI container listing calls to plugin
-            # (handle will be >= 0). Do not call self.finish() when called via
-            # RunPlugin() (handle will be -1).
-            if not self._end_of_directory and self.handle >= 0:
-                if listitems is None:
-                    self.finish(succeeded=False)
-                else:
-                    listitems = self.finish(listitems)
-
-            return listitems
-        raise NotFoundException('No matching view found for %s' % path)
+        view_func, items = self._router.match(path)
+        log.info('Request for "%s" matches rule for function "%s"',
+                 path, view_func.__name__)
+        listitems = view_func(**items)
+        # Only call self.finish() for UI container listing calls to plugin
+        # (handle will be >= 0). Do not call self.finish() when called via
+        # RunPlugin() (handle will be -1).
+        if not self._end_of_directory and self.handle >= 0:
+            if listitems is None:
+                self.finish(succeeded=False)
+            else:
+                listitems = self.finish(listitems)
+
+        return listitems
 
     def redirect(self, url):
         """Used when you need to redirect to another view, and you only
@@ -324,7 +326,29 @@ class Plugin(XBMCMixin):
     def addon_data_path(self, path=""):
         return os.path.join(xbmc.translatePath('special://profile/addon_data/%s/' % self._addon_id), path)
 
+    def on_close(self, func):
+        """Registers a function to be called by close_storages(), that is at the
+        end of every run() and service iteration.
+        """
+        if func not in self._close_handlers:
+            self._close_handlers.append(func)
+        return func
+
     def close_storages(self):
+        # Refresh stale cached results, so they get persisted, but don't keep
+        # XBMC waiting for a slow site
+        self.run_revalidations(REVALIDATION_TIMEOUT)
+        for func in self._close_handlers:
+            try:
+                func()
+            except Exception as e:
+                log.exception(e)
+        if hasattr(self, '_cache_stats'):
+            log.debug('Function cache stats: %(hit)d hit(s), %(stale)d stale hit(s), '
+                      '%(miss)d miss(es)', self._cache_stats)
+            del self._cache_stats
+        # Settings may be changed before the next run or service iteration
+        self.forget_settings()
         # Close any open storages which will persist them to disk
         if hasattr(self, '_unsynced_storages'):
             for storage in self._unsynced_storages.values():
@@ -336,6 +360,8 @@ class Plugin(XBMCMixin):
 
     def run(self):
         """The main entry point for a plugin."""
+        # the storages are committed by close_storages() at the end
+        self._commit_on_close = True
         try:
             self._request = self._parse_request()
             log.debug('Handling incoming request for %s', self.request.path)
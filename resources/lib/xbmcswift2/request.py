@@ -58,7 +58,8 @@ class Request(object):
         url_parts = list(urlparse.urlparse(remainder))
         query = dict(self.args)
         query.update(kwargs)
-        url_parts[4] = urllib.urlencode(query)
+        # args are lists of values, they are passed as repeated arguments
+        url_parts[4] = urllib.urlencode(query, 1)
         url_parts[0] = scheme
         return urlparse.urlunparse(url_parts)
 
@@ -423,7 +423,7 @@ class Storage(DictMixin):
             upd_dict = dict((k, v) for k, v in self.cache.iteritems()
                             if k not in self.original or not self.original[k] == v)
             if upd_dict:
-                log.debug("Updated storage keys: %s" % ", ".join(upd_dict.keys()))
+                log.debug("Updated storage keys: %s" % ", ".join(map(repr, upd_dict.keys())))
                 self.update(upd_dict)
             self.original = copy.deepcopy(self.cache)
             self.cached = True
@@ -8,8 +8,9 @@
     :license: GPLv3, see LICENSE for more details.
 """
 import re
-from urllib import urlencode, unquote_plus, quote_plus
-from xbmcswift2.common import pickle_args, unpickle_dict
+import pickle
+from urllib import unquote_plus, quote_plus
+from xbmcswift2.common import unpickle_dict
 
 
 # TODO: Use regular Exceptions
@@ -21,6 +22,53 @@ class NotFoundException(Exception):
     pass
 
 
+def _quote_value(val):
+    """Returns an urlencoded string for the given value. Ints are written as
+    decimal numbers and bools as 1 or 0. Query string values are converted
+    back to ints by Request.args and path values by match() (unless the rule
+    declares a converter), so False is read as 0 either way.
+    """
+    if isinstance(val, basestring):
+        return quote_plus(val)
+    if isinstance(val, bool):
+        return '1' if val else '0'
+    if isinstance(val, (int, long)):
+        return str(val)
+    raise TypeError('Value "%s" must be an instance of basestring, int or '
+                    'bool' % val)
+
+
+def _quote_qs_value(val):
+    # the same as urlencode() does for str and unicode values
+    if isinstance(val, unicode):
+        return quote_plus(val.encode('ASCII', 'replace'))
+    return quote_plus(val)
+
+
+def _legacy_convert(items):
+    """Unpickles pickled values and converts strings to integers where
+    possible, for variables declared without a converter.
+    """
+    items = unpickle_dict(items)
+    for key, val in items.items():
+        if isinstance(val, basestring):
+            try:
+                items[key] = int(val)
+            except ValueError:
+                pass
+    return items
+
+
+#: Converters which can be declared for url rule variables, e.g. <int:id>.
+#: A converter raising ValueError makes the rule not match the path.
+CONVERTERS = {
+    'int': int,
+    'str': str,
+}
+
+_VARIABLE_RE = re.compile(r'<(?:(\w+):)?(.+?)>')
+
+
 class UrlRule(object):
     """This object stores the various properties related to a routing URL rule.
     It also provides a few methods to create URLs from the rule or to match a
@@ -28,7 +76,9 @@ class UrlRule(object):
 
     :param url_rule: The relative url pattern for the rule. It may include
                      <var_name> to denote where dynamic variables should be
-                     matched.
+                     matched. The variable may declare a converter from
+                     CONVERTERS, e.g. <int:var_name>, otherwise pickled
+                     values are unpickled and integers are converted.
     :param view_func: The function that should be bound to this rule. This
                       should be an actual function object.
 
@@ -44,17 +94,43 @@ class UrlRule(object):
         self._url_rule = url_rule
         self._view_func = view_func
         self._options = options or {}
-        self._keywords = re.findall(r'<(.+?)>', url_rule)
+        self._keywords = []
+        # keyword -> converter, for the variables which declare one
+        self._converters = {}
+        for converter, keyword in _VARIABLE_RE.findall(url_rule):
+            if converter:
+                if converter not in CONVERTERS:
+                    raise ValueError('Unknown converter "%s" in URL rule "%s"'
+                                     % (converter, url_rule))
+                self._converters[keyword] = CONVERTERS[converter]
+            self._keywords.append(keyword)
 
         # change <> to {} for use with str.format()
-        self._url_format = self._url_rule.replace('<', '{').replace('>', '}')
+        self._url_format = _VARIABLE_RE.sub(r'{\2}', url_rule)
+
+        # Precompiled path builder: the keywords go between the literal parts
+        self._path_parts = re.split(r'<.+?>', url_rule)
+        self._keyword_set = frozenset(self._keywords)
+
+        # Path segments for the router: (True, keyword) for variables and
+        # (False, text) for literals, or None if a segment mixes them
+        self._segments = []
+        for segment in url_rule.rstrip('/').split('/')[1:]:
+            m = _VARIABLE_RE.match(segment)
+            if m and m.end() == len(segment):
+                self._segments.append((True, m.group(2)))
+            elif '<' not in segment:
+                self._segments.append((False, segment))
+            else:
+                self._segments = None
+                break
 
         # Make a regex pattern for matching incoming URLs
         rule = self._url_rule
         if rule != '/':
             # Except for a path of '/', the trailing slash is optional.
             rule = self._url_rule.rstrip('/') + '/?'
-        p = rule.replace('<', '(?P<').replace('>', '>[^/]+?)')
+        p = _VARIABLE_RE.sub(r'(?P<\2>[^/]+?)', rule)
 
         try:
             self._regex = re.compile('^' + p + '$')
@@ -85,55 +161,88 @@ class UrlRule(object):
         m = self._regex.search(path)
         if not m:
             raise NotFoundException
+        return self.convert(m.groupdict())
 
-        # urlunencode the values
-        items = dict((key, unquote_plus(val))
-                     for key, val in m.groupdict().items())
-
-        # unpickle any items if present
-        items = unpickle_dict(items)
+    def convert(self, values):
+        """Returns the bound function and the items to be passed to it for
+        the given dictionary of urlencoded values of path variables.
 
-        # Convert string to integers where possible
-        for key, val in items.items():
-            if isinstance(val, basestring):
-                try:
-                    items[key] = int(val)
-                except ValueError:
-                    pass
+        Raises NotFoundException if a declared converter rejects a value.
+        """
+        items = {}
+        legacy = {}
+        for key, val in values.iteritems():
+            val = unquote_plus(val)
+            converter = self._converters.get(key)
+            if converter is None:
+                legacy[key] = val
+                continue
+            try:
+                items[key] = converter(val)
+            except ValueError:
+                raise NotFoundException
+        if legacy:
+            items.update(_legacy_convert(legacy))
 
         # We need to update our dictionary with default values provided in
         # options if the keys don't already exist.
-        [items.setdefault(key, val) for key, val in self._options.items()]
+        for key, val in self._options.iteritems():
+            items.setdefault(key, val)
         return self._view_func, items
 
     def _make_path(self, items):
         """Returns a relative path for the given dictionary of items.
 
         Uses this url rule's url pattern and replaces instances of <var_name>
-        with the appropriate value from the items dict.
+        with the appropriate value from the items dict, or from the defaults
+        of the rule.
         """
-        for key, val in items.items():
-            if not isinstance(val, basestring):
+        parts = self._path_parts
+        path = [parts[0]]
+        for i, key in enumerate(self._keywords):
+            val = items[key] if key in items else self._options[key]
+            try:
+                path.append(_quote_value(val))
+            except TypeError:
                 raise TypeError('Value "%s" for key "%s" must be an instance'
                                 ' of basestring' % (val, key))
-            items[key] = quote_plus(val)
-
-        try:
-            path = self._url_format.format(**items)
-        except AttributeError:
-            # Old version of python
-            path = self._url_format
-            for key, val in items.items():
-                path = path.replace('{%s}' % key, val)
-        return path
-
-    @staticmethod
-    def _make_qs(items):
-        """Returns a query string for the given dictionary of items. All keys
-        and values in the provided items will be urlencoded. If necessary, any
-        python objects will be pickled before being urlencoded.
+            path.append(parts[i + 1])
+        # quoted unicode values are ASCII, the path is always str
+        return str(''.join(path))
+
+    def _make_qs(self, items):
+        """Returns a query string for the items of the given dictionary which
+        aren't keywords of this url rule. All keys and values will be
+        urlencoded. If necessary, any python objects will be pickled before
+        being urlencoded.
         """
-        return urlencode(pickle_args(items), 1)
+        qs = []
+        pickled_keys = []
+        for key, val in items.iteritems():
+            if key in self._keyword_set or val is None:
+                continue
+            name = _quote_qs_value(key) + '='
+            if isinstance(val, basestring):
+                qs.append(name + _quote_qs_value(val))
+                continue
+            if isinstance(val, (int, long)):
+                qs.append(name + _quote_value(val))
+                continue
+            try:
+                len(val)
+            except TypeError:
+                val = [val]
+            # sequences are passed as repeated arguments
+            for v in val:
+                if isinstance(v, basestring):
+                    qs.append(name + _quote_qs_value(v))
+                else:
+                    if key not in pickled_keys:
+                        pickled_keys.append(key)
+                    qs.append(name + quote_plus(pickle.dumps(v)))
+        if pickled_keys:
+            qs.append('_pickled=' + quote_plus(','.join(pickled_keys)))
+        return '&'.join(qs)
 
     def make_path_qs(self, items):
         """Returns a relative path complete with query string for the given
@@ -143,8 +252,9 @@ class UrlRule(object):
         into the path. Any remaining items will be appended as query string
         parameters.
 
-        All items will be urlencoded. Any items which are not instances of
-        basestring, or int/long will be pickled before being urlencoded.
+        All items will be urlencoded. Ints are written as decimal numbers and
+        bools as 1 or 0. Any other items which are not instances of basestring
+        will be pickled before being urlencoded.
 
         .. warning:: The pickling of items only works for key/value pairs which
                      will be in the query string. This behavior should only be
@@ -153,29 +263,10 @@ class UrlRule(object):
                      hard limit on URL length. See the caching section if you
                      need to persist a large amount of data between requests.
         """
-        # Convert any ints and longs to strings
-        for key, val in items.items():
-            if isinstance(val, (int, long)):
-                items[key] = str(val)
-
-        # First use our defaults passed when registering the rule
-        url_items = dict((key, val) for key, val in self._options.items()
-                         if key in self._keywords)
-
-        # Now update with any items explicitly passed to url_for
-        url_items.update((key, val) for key, val in items.items()
-                         if key in self._keywords)
-
-        # Create the path
-        path = self._make_path(url_items)
-
-        # Extra arguments get tacked on to the query string
-        qs_items = dict((key, val) for key, val in items.items()
-                        if key not in self._keywords and val is not None)
-        qs = self._make_qs(qs_items)
-
+        path = self._make_path(items)
+        qs = self._make_qs(items)
         if qs:
-            return '?'.join([path, qs])
+            return path + '?' + qs
         return path
 
     @property
@@ -202,3 +293,93 @@ class UrlRule(object):
     def keywords(self):
         """The list of path keywords for this url rule."""
         return self._keywords
+
+    @property
+    def segments(self):
+        """The list of (is_variable, keyword or text) tuples for the path
+        segments of this url rule, or None if it can only be matched with
+        the regex.
+        """
+        return self._segments
+
+
+class _Node(object):
+    def __init__(self):
+        # literal segment -> node
+        self.literals = {}
+        # node for a variable segment
+        self.variable = None
+        # (index, rule) of the rules ending at this node
+        self.rules = []
+
+
+class Router(object):
+    """Finds the url rule for a path. Rules are kept in a trie of path
+    segments, so a path is matched by walking its segments instead of trying
+    every rule. If several rules match, the one added first wins, as the
+    rules are tried in order of addition.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        # (index, rule) of the rules with segments mixing text and variables
+        self._regex_rules = []
+        self._count = 0
+
+    def add(self, rule):
+        """
+        :type rule: UrlRule
+        """
+        index = self._count
+        self._count += 1
+        if rule.segments is None:
+            self._regex_rules.append((index, rule))
+            return
+        node = self._root
+        for is_variable, value in rule.segments:
+            if is_variable:
+                if node.variable is None:
+                    node.variable = _Node()
+                node = node.variable
+            else:
+                node = node.literals.setdefault(value, _Node())
+        node.rules.append((index, rule))
+
+    def _collect(self, node, segments, i, values, result):
+        if i == len(segments):
+            result.extend((index, rule, values) for index, rule in node.rules)
+            return
+        segment = segments[i]
+        child = node.literals.get(segment)
+        if child is not None:
+            self._collect(child, segments, i + 1, values, result)
+        if node.variable is not None and segment:
+            self._collect(node.variable, segments, i + 1, values + [segment], result)
+
+    def match(self, path):
+        """Returns the bound function of the first matching url rule and the
+        items to be passed to it, as UrlRule.match() does.
+
+        Raises NotFoundException if no rule matches the path.
+        """
+        candidates = []
+        if path.startswith('/'):
+            segments = path[1:].split('/')
+            # the trailing slash is optional
+            if segments[-1] == '':
+                segments.pop()
+            self._collect(self._root, segments, 0, [], candidates)
+        for index, rule in self._regex_rules:
+            m = rule.regex.search(path)
+            if m:
+                candidates.append((index, rule, m.groupdict()))
+        if len(candidates) > 1:
+            candidates.sort(key=lambda c: c[0])
+        for index, rule, values in candidates:
+            if isinstance(values, list):
+                values = dict(zip(rule.keywords, values))
+            try:
+                return rule.convert(values)
+            except NotFoundException:
+                continue
+        raise NotFoundException('No matching view found for %s' % path)
@@ -1,6 +1,9 @@
 import os
 import time
+import json
+import threading
 
+from collections import namedtuple
 from functools import wraps
 
 import xbmcswift2
@@ -10,6 +13,15 @@ from xbmcswift2.logger import log
 from xbmcswift2.constants import VIEW_MODES, SortMethod
 from xbmcswift2.common import ensure_str
 
+# Result of cached function along with the time (in seconds since epoch) it
+# was obtained
+CachedResult = namedtuple('CachedResult', ['value', 'created'])
+
+_cache_lock = threading.RLock()
+
+# Seconds given to the revalidations of stale results when the storages are
+# closed, the ones not started by then are left for the next invocations
+REVALIDATION_TIMEOUT = 3
 
 # noinspection PyAttributeOutsideInit,PyUnresolvedReferences
 class XBMCMixin(object):
@@ -42,19 +54,31 @@ class XBMCMixin(object):
 
     _function_cache_name = '.functions'
 
-    def cached(self, ttl=60 * 24):
+    # Set by run(), which commits the storages at the end of the invocation.
+    # Otherwise (e.g. in a long-running service) cached results are synced
+    # to disk as soon as they are stored.
+    _commit_on_close = False
+
+    def cached(self, ttl=60 * 24, stale_ttl=None):
         """A decorator that will cache the output of the wrapped function. The
         key used for the cache is the function name as well as the `*args` and
         `**kwargs` passed to the function.
 
+        Within run() results are not written to disk immediately, they are
+        committed together with the other storages at the end of the plugin
+        invocation.
+
         :param ttl: time to live in minutes
+        :param stale_ttl: (Optional) time in minutes after `ttl` expiration
+                          during which the stale result is still returned
+                          immediately, while the function is called again
+                          at the end of the invocation (see
+                          :meth:`run_revalidations`) to refresh the cache.
 
         .. note:: For route caching, you should use
                   :meth:`xbmcswift2.Plugin.cached_route`.
         """
         def decorating_function(function):
-            # TODO test this method
-            storage = self.get_storage(self._function_cache_name, ttl=ttl)
             kwd_mark = 'f35c2d973e1bbbc61ca60fc6d7ae4eb3'
 
             @wraps(function)
@@ -62,23 +86,93 @@ class XBMCMixin(object):
                 key = (function.__name__, kwd_mark,) + args
                 if kwargs:
                     key += (kwd_mark,) + tuple(sorted(kwargs.items()))
-
-                try:
-                    result = storage[key]
-                    log.debug('Storage hit for function "%s" with args "%s" '
-                              'and kwargs "%s"', function.__name__, args,
-                              kwargs)
-                except KeyError:
-                    log.debug('Storage miss for function "%s" with args "%s" '
-                              'and kwargs "%s"', function.__name__, args,
-                              kwargs)
-                    result = function(*args, **kwargs)
-                    storage[key] = result
+                # the storage is reopened after close_storages(), so it's not
+                # kept between calls
+                storage = self.get_storage(self._function_cache_name, ttl=ttl + (stale_ttl or 0))
+
+                entry = storage.get(key)
+                if isinstance(entry, CachedResult):
+                    age = time.time() - entry.created
+                    if age < ttl * 60:
+                        self._count_cache_access('hit')
+                        log.debug('Storage hit for function "%s" with args "%s" '
+                                  'and kwargs "%s"', function.__name__, args,
+                                  kwargs)
+                        return entry.value
+                    if stale_ttl and age < (ttl + stale_ttl) * 60:
+                        self._count_cache_access('stale')
+                        log.debug('Storage stale hit for function "%s" with args "%s" '
+                                  'and kwargs "%s"', function.__name__, args,
+                                  kwargs)
+                        self._revalidate(key, ttl + stale_ttl, function, args, kwargs)
+                        return entry.value
+
+                self._count_cache_access('miss')
+                log.debug('Storage miss for function "%s" with args "%s" '
+                          'and kwargs "%s"', function.__name__, args,
+                          kwargs)
+                result = function(*args, **kwargs)
+                storage[key] = CachedResult(result, time.time())
+                if not self._commit_on_close:
                     storage.sync()
                 return result
             return wrapper
         return decorating_function
 
+    @property
+    def cache_stats(self):
+        """A dict with the number of hits, stale hits and misses of
+        :meth:`xbmcswift2.Plugin.cached` functions during this invocation.
+        """
+        if not hasattr(self, '_cache_stats'):
+            self._cache_stats = {'hit': 0, 'stale': 0, 'miss': 0}
+        return self._cache_stats
+
+    def _count_cache_access(self, outcome):
+        with _cache_lock:
+            self.cache_stats[outcome] += 1
+
+    def _revalidate(self, key, storage_ttl, function, args, kwargs):
+        """Schedules the function to be called again by run_revalidations()
+        to refresh its stale result. Storages and sessions used by cached
+        functions can only be used from the thread which opened them, so the
+        function isn't called in background but after the view is done.
+        """
+        with _cache_lock:
+            if not hasattr(self, '_revalidations'):
+                self._revalidations = []
+            if all(k != key for k, _ in self._revalidations):
+                self._revalidations.append((key, (storage_ttl, function, args, kwargs)))
+
+    def run_revalidations(self, timeout=None):
+        """Calls the functions which returned stale results in this invocation
+        and stores their fresh results, so they are committed along with the
+        storages. Called from the main thread by close_storages().
+
+        :param timeout: (Optional) seconds after which no more revalidations
+                        are started, the rest are dropped.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            with _cache_lock:
+                revalidations = getattr(self, '_revalidations', None)
+                if not revalidations:
+                    return
+                if deadline is not None and time.time() >= deadline:
+                    log.warning('Dropping %d revalidation(s) out of time', len(revalidations))
+                    self._revalidations = []
+                    return
+                key, (storage_ttl, function, args, kwargs) = revalidations.pop(0)
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                log.warning('Revalidation of function "%s" failed: %s', function.__name__, e)
+                continue
+            storage = self.get_storage(self._function_cache_name, ttl=storage_ttl)
+            storage[key] = CachedResult(result, time.time())
+            log.debug('Revalidated function "%s" with args "%s" and '
+                      'kwargs "%s"', function.__name__, args, kwargs)
+
     def clear_function_cache(self):
         """Clears the storage that caches results when using
         :meth:`xbmcswift2.Plugin.cached_route` or
@@ -184,6 +278,29 @@ class XBMCMixin(object):
         # TODO: allow pickling of settings items?
         # TODO: STUB THIS OUT ON CLI
         value = self.addon.getSetting(id=key)
+        return self._convert_setting(value, converter, choices, default)
+
+    def cached_setting(self, key, converter=None, choices=None, default=0):
+        """Same as get_setting(), but the value is read from the addon only
+        once per invocation (until close_storages() or set_setting() of the
+        key). Intended for code which runs for every listing item, settings
+        polled by long-running code must be read with get_setting().
+        """
+        if not hasattr(self, '_settings'):
+            self._settings = {}
+        if key not in self._settings:
+            self._settings[key] = self.addon.getSetting(id=key)
+        return self._convert_setting(self._settings[key], converter, choices, default)
+
+    def forget_settings(self):
+        """Drops settings and strings read by cached_setting() and
+        get_string(), so they are read from the addon again.
+        """
+        self.__dict__.pop('_settings', None)
+        self.__dict__.pop('_strings', None)
+
+    @staticmethod
+    def _convert_setting(value, converter=None, choices=None, default=0):
         if converter is str:
             return value
         elif converter is unicode:
@@ -206,6 +323,8 @@ class XBMCMixin(object):
     def set_setting(self, key, val):
         if isinstance(val, bool):
             val = str(val).lower()
+        if hasattr(self, '_settings'):
+            self._settings.pop(key, None)
         return self.addon.setSetting(id=key, value=val)
 
     def open_settings(self):
@@ -269,6 +388,52 @@ class XBMCMixin(object):
     def clean_library(library, popup=True):
         xbmc.executebuiltin('CleanLibrary(%s,%s)' % (library, popup))
 
+    @staticmethod
+    def execute_json_rpc(*calls):
+        """Executes JSON-RPC calls, given as (method, params) tuples, in one
+        batch.
+
+        :return: list of results of the calls, None for the failed ones
+        """
+        batch = [{'jsonrpc': '2.0', 'method': method, 'params': params, 'id': i}
+                 for i, (method, params) in enumerate(calls)]
+        results = [None] * len(calls)
+        try:
+            response = json.loads(xbmc.executeJSONRPC(json.dumps(batch)))
+        except ValueError as e:
+            log.warning('Invalid JSON-RPC response: %s', e)
+            return results
+        if isinstance(response, dict):
+            response = [response]
+        for r in response:
+            if 'error' in r:
+                log.warning('JSON-RPC call %s failed: %s', calls[r['id']][0] if r.get('id') is not None else '',
+                            r['error'])
+            else:
+                results[r['id']] = r.get('result')
+        return results
+
+    @staticmethod
+    def update_library_paths(library, paths, popup=True):
+        """Scans only the given paths of the library, with one JSON-RPC
+        request. Falls back to UpdateLibrary builtin if JSON-RPC is failed.
+        """
+        method = 'VideoLibrary.Scan' if library == 'video' else 'AudioLibrary.Scan'
+        results = XBMCMixin.execute_json_rpc(*[(method, {'directory': p, 'showdialogs': popup}) for p in paths])
+        for path, result in zip(paths, results):
+            if result != 'OK':
+                XBMCMixin.update_library(library, path, popup)
+
+    @staticmethod
+    def clean_library_paths(library, paths, popup=True):
+        """Cleans only the given paths of the library, if XBMC supports it,
+        otherwise cleans the whole library.
+        """
+        method = 'VideoLibrary.Clean' if library == 'video' else 'AudioLibrary.Clean'
+        results = XBMCMixin.execute_json_rpc(*[(method, {'directory': p, 'showdialogs': popup}) for p in paths])
+        if any(r != 'OK' for r in results):
+            XBMCMixin.clean_library(library, popup)
+
     @staticmethod
     def is_scanning_library():
         return xbmc.getCondVisibility('Library.IsScanningVideo') or xbmc.getCondVisibility('Library.IsScanningMusic')
@@ -12,6 +12,8 @@ from xbmcswift2 import sleep, abort_requested, xbmc
 from support.common import LocalizedError, lang, notify
 from lostfilm.common import update_library, is_authorized
 from support.plugin import plugin
+from support.services import refresh_proxy_list
+from support.abstract.proxylist import ProxyListException
 
 
 def safe_update_library():
@@ -31,10 +33,24 @@ def safe_update_library():
         plugin.close_storages()
     return False
 
+
+def safe_refresh_proxy_list():
+    try:
+        if plugin.get_setting('use-proxy', int):
+            refresh_proxy_list()
+    except ProxyListException as e:
+        plugin.log.warn("Can't refresh proxy list, keeping the old one: %s" % e)
+    except Exception as e:
+        plugin.log.exception(e)
+    finally:
+        plugin.close_storages()
+
 if __name__ == '__main__':
     sleep(5000)
     safe_update_library()
+    safe_refresh_proxy_list()
     next_run = None
+    next_proxy_check = datetime.datetime.now() + datetime.timedelta(hours=1)
     while not abort_requested():
         now = datetime.datetime.now()
         update_on_demand = plugin.get_setting('update-library', bool)
@@ -49,4 +65,7 @@ if __name__ == '__main__':
                 if updated:
                     plugin.refresh_container()
             next_run = None
+        if now > next_proxy_check:
+            safe_refresh_proxy_list()
+            next_proxy_check = now + datetime.timedelta(hours=1)
         sleep(1000)